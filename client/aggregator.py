@@ -0,0 +1,149 @@
+"""
+An aggregator between a group of workers and a ROUTER
+server that sums the results of its workers locally
+
+@author: Joseph Jennings
+@version: 2020.10.14
+"""
+import zmq
+from collections import deque
+from comm.sendrecv import loads_ctl, loads_frames, nbytes, notify_server, needs_decode, release_frames
+from client.worker import send_result, partialsum
+from server.store import decode_message
+from server.dispatch import result_cids
+
+def aggregator(frontend,backend,rkey=None,ikey='idx',nflush=None,oob=False,codec=None,
+               fetcher=None,sink=None) -> None:
+  """
+  Relays the chunks of a ROUTER server to the workers connected to
+  the aggregator and returns their results to the server. With rkey,
+  the results are summed on the aggregator and only the partial sums
+  are returned to the server (dstr_sum with credits=None). Once the
+  server has no more work, each worker is told on the aggregator
+  (e.g., to return the partial sum it keeps)
+
+  Parameters:
+    frontend - a bound ZMQ ROUTER socket to which the workers (DEALER
+               or REQ sockets) connect
+    backend  - a ZMQ DEALER socket connected to the server
+    rkey     - the result key to be summed [None, results are forwarded]
+    ikey     - key for the index for chunked transfer ['idx']
+    nflush   - return the partial sum every nflush chunks
+               [None, only when there is no more work]
+    oob      - send with out-of-band buffers [False]
+    codec    - name of a codec or 'auto' for the partial sums (overrides oob) [None]
+    fetcher  - a second ZMQ DEALER socket connected to the server through
+               which the shared objects are fetched for the workers [None]
+    sink     - a function sink(rdict) that consumes each result on the
+               aggregator. The server is only told which chunks are done
+               (e.g., for a sharded server, server.shard) [None]
+  """
+  reducer = partialsum(rkey,ikey,nflush) if(rkey is not None) else None
+  # Workers waiting for a chunk (in the order of their credits)
+  idle  = deque()
+  # Number of credits passed to the server and not yet answered
+  owed  = 0
+  # Chunks handed out again by the server after the end of work
+  # while no worker was waiting
+  queued = deque()
+  # The server sends a single end-of-work chunk to the aggregator.
+  # Each worker is told once on the aggregator instead
+  ended = False
+  told  = set()
+  endwork = None
+  def serve(wid,env):
+    """ Serves a credit of worker wid locally. Returns False if the worker waits """
+    if(len(queued) > 0):
+      frontend.send_multipart([wid] + env + queued.popleft(),copy=False)
+      return True
+    if(ended and wid.bytes not in told):
+      told.add(wid.bytes)
+      frontend.send_multipart([wid] + env + endwork)
+      return True
+    idle.append((wid,env))
+    return False
+  poller = zmq.Poller()
+  poller.register(frontend,zmq.POLLIN)
+  poller.register(backend,zmq.POLLIN)
+  while True:
+    # Each waiting worker keeps a credit on the server (the end-of-work
+    # chunks already answered on the aggregator are dropped), e.g., for the next job
+    while(owed < len(idle)):
+      notify_server(backend,oob)
+      owed += 1
+    socks = dict(poller.poll())
+    if(backend in socks):
+      frames = backend.recv_multipart(copy=False)
+      owed -= 1
+      if(nbytes(frames) < 128 and loads_frames(frames) == {}):
+        # No more work on the server
+        endwork = [frame.bytes for frame in frames]
+        if(not ended):
+          ended = True
+          if(reducer is not None and not reducer.empty()):
+            send_result(backend,{},reducer.flush(),oob,nxt=False,codec=codec)
+        # Tell the waiting workers (the others are told when they ask)
+        for iwait in range(len(idle)):
+          serve(*idle.popleft())
+      else:
+        # A chunk for the next waiting worker
+        if(needs_decode(frames)):
+          release_frames(frames)
+          raise Exception("Chunks sent with codec 'shm' cannot be forwarded by an aggregator")
+        ended = False
+        told.clear()
+        if(len(idle) > 0):
+          wid,env = idle.popleft()
+          frontend.send_multipart([wid] + env + frames,copy=False)
+        else:
+          queued.append(frames)
+    if(frontend in socks):
+      frames = frontend.recv_multipart(copy=False)
+      wid,frames = frames[0],frames[1:]
+      # REQ workers send an empty delimiter
+      env = []
+      if(len(frames[0].bytes) == 0):
+        env,frames = frames[:1],frames[1:]
+      ctl,whole = loads_ctl(frames)
+      if(ctl['msg'] == "available"):
+        # Pass the credit (and the chunks kept by the worker) to the server.
+        # After the end of work, the worker is answered on the aggregator
+        if(not serve(wid,env)):
+          backend.send_multipart(frames,copy=False)
+          owed += 1
+      elif(ctl['msg'] == "fetch"):
+        if(fetcher is None):
+          raise Exception("Please provide a fetcher socket to fetch shared objects")
+        fetcher.send_multipart(frames,copy=False)
+        frontend.send_multipart([wid] + env + fetcher.recv_multipart(copy=False),copy=False)
+      elif(ctl['msg'] == "result"):
+        nxt = ctl.get('next',False)
+        if(nxt):
+          serve(wid,env)
+          owed += 1
+        elif(len(env) > 0):
+          # Thank the REQ worker
+          frontend.send_multipart([wid] + env + [b""])
+        if(reducer is None and sink is None):
+          if(needs_decode(frames)):
+            release_frames(frames)
+            raise Exception("Results sent with codec 'shm' cannot be forwarded by an aggregator")
+          backend.send_multipart(frames,copy=False)
+          continue
+        rdicts = decode_message(ctl,None if(whole) else frames)
+        if(sink is not None):
+          for rdict in rdicts:
+            sink(rdict)
+          # Tell the server the chunks are done (and pass the credit)
+          send_result(backend,ctl,{'_cids': result_cids(ctl)},oob,nxt=nxt)
+          continue
+        if(ctl.get('_partial',False)):
+          reducer.merge(rdicts[0])
+        else:
+          for rdict in rdicts:
+            reducer.add(rdict,rdict)
+        if(nxt):
+          # Pass the credit and tell the server the chunks are done
+          notify_server(backend,oob,result_cids(ctl),job=ctl.get('_job'))
+        if(reducer.full() or ended):
+          send_result(backend,{},reducer.flush(),oob,nxt=False,codec=codec)
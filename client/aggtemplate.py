@@ -0,0 +1,29 @@
+"""
+A template for an aggregator that will be launched on
+a node of a cluster (e.g., with launch_sshworkers,
+launch_slurmworkers or launch_pbsworkers). The workers
+of the node connect to the aggregator instead of
+the ROUTER server (server.utils.startrouter)
+
+@author: Joseph Jennings
+@version: 2020.10.14
+"""
+import zmq # ZMQ sockets
+from client.aggregator import aggregator # Aggregator loop
+
+# Socket for the workers of this node (connect to tcp://thisnode:5560)
+context = zmq.Context()
+frontend = context.socket(zmq.ROUTER)
+frontend.bind("tcp://*:5560")
+
+# Connect to the server
+backend = context.socket(zmq.DEALER)
+backend.connect("tcp://serveraddr:5555")
+# Socket through which shared objects are fetched (server.broadcast)
+fetcher = context.socket(zmq.DEALER)
+fetcher.connect("tcp://serveraddr:5555")
+
+# Sum the results of the workers and return the partial sums to dstr_sum
+aggregator(frontend,backend,rkey='result',fetcher=fetcher)
+# Forward the results of the workers (e.g., for dstr_collect)
+#aggregator(frontend,backend,fetcher=fetcher)
@@ -0,0 +1,222 @@
+"""
+Worker cache of the shared data registered on the
+server (server.broadcast)
+
+@author: Joseph Jennings
+@version: 2020.10.09
+"""
+import os, sys
+import pickle
+from collections import OrderedDict
+from comm.sendrecv import dumps_frames, loads_frames, nbytes, _framebuf
+
+class sharedcache:
+  """
+  Keeps the shared objects fetched from the server so that each
+  object is transferred once to a worker. The least recently
+  used objects are evicted when the cache exceeds its size
+  (and kept on local scratch if a scratch directory is given)
+
+  With a relay, the encoded frames of an object are also kept
+  (and forwarded to other workers) until the object is evicted.
+  They count toward the size of the cache
+  """
+
+  def __init__(self,maxbytes=None,scratch=None,relay=None):
+    """
+    sharedcache constructor
+
+    Parameters:
+      maxbytes - maximum size of the objects kept in memory [None, unbounded]
+      scratch  - a local directory in which evicted objects are kept [None]
+      relay    - a relay (comm.relay) through which the objects are received
+                 from and forwarded to other workers when the server
+                 broadcasts through a tree [None]
+    """
+    self.maxbytes = maxbytes
+    self.scratch  = scratch
+    self.relay    = relay
+    if(scratch is not None):
+      os.makedirs(scratch,exist_ok=True)
+    self.objs   = OrderedDict()
+    self.sizes  = {}
+    self.nbytes = 0
+
+  def get(self,hsh):
+    """ Returns a cached object (None if not cached) """
+    if(hsh in self.objs):
+      self.objs.move_to_end(hsh)
+      return self.objs[hsh]
+    fname = self.scrfile(hsh)
+    if(fname is not None and os.path.exists(fname)):
+      with open(fname,'rb') as f:
+        obj = pickle.load(f)
+      self.put(hsh,obj)
+      return obj
+    return None
+
+  def put(self,hsh,obj,extra=0) -> None:
+    """
+    Adds an object to the cache and evicts the oldest ones if needed
+
+    Parameters:
+      hsh   - the hash of the object
+      obj   - the object
+      extra - bytes held for the object elsewhere (e.g., its frames
+              in the relay, freed when the object is evicted) [0]
+    """
+    self.objs[hsh]  = obj
+    self.sizes[hsh] = objsize(obj) + extra
+    self.nbytes    += self.sizes[hsh]
+    while(self.maxbytes is not None and self.nbytes > self.maxbytes and len(self.objs) > 1):
+      ohsh,oobj = self.objs.popitem(last=False)
+      self.nbytes -= self.sizes.pop(ohsh)
+      if(self.relay is not None):
+        self.relay.unpublish(ohsh)
+      fname = self.scrfile(ohsh)
+      if(fname is not None and not os.path.exists(fname)):
+        with open(fname,'wb') as f:
+          pickle.dump(oobj,f,protocol=-1)
+
+  def scrfile(self,hsh):
+    """ Returns the scratch file of an object (None without scratch) """
+    if(self.scratch is None): return None
+    return os.path.join(self.scratch,hsh + '.pkl')
+
+  def fetch(self,socket,hsh,oob=False,stash=None,direct=False):
+    """
+    Fetches a shared object from the server
+
+    Parameters:
+      socket - the ZMQ socket (REQ or DEALER)
+      hsh    - the hash of the object
+      oob    - send with out-of-band buffers [False]
+      stash  - a deque in which chunks received while waiting
+               for the object are kept (DEALER socket) [None]
+      direct - fetch from the server even with a relay. The
+               object is then published on the relay for the
+               workers below this one in the tree [False]
+
+    Returns the object (None if the server no longer has it) and
+    the number of bytes of its frames kept in the relay
+    """
+    req = {'msg': "fetch", '_shared': hsh}
+    if(self.relay is not None and not direct):
+      req['_relay'] = self.relay.address
+    socket.send_multipart(dumps_frames(req,oob),copy=False)
+    while True:
+      frames = socket.recv_multipart(copy=False)
+      msg = loads_frames(frames)
+      if(isinstance(msg,dict) and msg.get('_shared') == hsh):
+        break
+      if(stash is None):
+        raise Exception("Received a chunk while fetching shared object %s"%(hsh))
+      stash.append(msg)
+    if(msg.get('_gone',False)):
+      return None,0
+    if('_parent' not in msg):
+      if(not direct or self.relay is None):
+        return msg['obj'],0
+      # Serve the workers waiting for the object below this one (the
+      # frames after the envelope are copied as obj may share their memory)
+      frames = [bytes(_framebuf(frame)) for frame in frames[2:]]
+      self.relay.publish(hsh,frames)
+      return msg['obj'],nbytes(frames)
+    # Receive the object through the tree
+    frames = self.relay.pull(hsh,msg['_parent'])
+    if(frames is None):
+      # The parent was lost
+      return self.fetch(socket,hsh,oob,stash,direct=True)
+    # Decoded from a copy so that changing the object does not
+    # change the frames forwarded to the other workers
+    return loads_frames([bytearray(frame) for frame in frames])['obj'],nbytes(frames)
+
+  def resolve(self,chunk,socket,oob=False,stash=None):
+    """
+    Replaces the references of a chunk (or of the chunks of
+    a batch) by the shared objects, fetching the missing ones
+
+    Returns the chunk with the objects in chunk[name]. The references
+    (hashes) are kept in chunk['_refs']. A chunk whose objects are gone
+    from the server (a late chunk of a job that is over) is marked as
+    stale ('_stale') and is not processed
+    """
+    if('_batch' in chunk):
+      chunk['_batch'] = [self.resolve(ichunk,socket,oob,stash) for ichunk in chunk['_batch']]
+      return chunk
+    for name,hsh in chunk.get('_refs',{}).items():
+      obj = self.load(hsh,socket,oob,stash)
+      if(obj is None):
+        chunk['_stale'] = True
+        continue
+      chunk[name] = obj
+    return chunk
+
+  def load(self,hsh,socket=None,oob=False,stash=None):
+    """
+    Returns a shared object, fetching it if it is not cached
+    (None if the server no longer has it). Without a socket,
+    the object must be cached (or on scratch)
+    """
+    obj = self.get(hsh)
+    if(obj is not None):
+      return obj
+    if(socket is None):
+      raise Exception("Shared object %s is not cached"%(hsh))
+    obj,extra = self.fetch(socket,hsh,oob,stash)
+    if(obj is not None):
+      self.put(hsh,obj,extra)
+    return obj
+
+  def export(self,chunk,socket,scratch,oob=False,stash=None):
+    """
+    Saves the shared objects of a chunk (or of the chunks of a batch)
+    in the directory scratch, fetching the missing ones, so that other
+    processes can load them (a sharedcache with the same scratch). The
+    references are kept in the chunk
+
+    Returns the chunk
+    """
+    if('_batch' in chunk):
+      for ichunk in chunk['_batch']:
+        self.export(ichunk,socket,scratch,oob,stash)
+      return chunk
+    refs = chunk.get('_refs',{})
+    for name,hsh in list(refs.items()):
+      fname = os.path.join(scratch,hsh + '.pkl')
+      if(os.path.exists(fname)): continue
+      obj = self.load(hsh,socket,oob,stash)
+      if(obj is None):
+        chunk['_stale'] = True
+        del refs[name]
+        continue
+      # Renamed once complete so that a partial file is never loaded
+      with open(fname + '.tmp','wb') as f:
+        pickle.dump(obj,f,protocol=-1)
+      os.replace(fname + '.tmp',fname)
+    return chunk
+
+# Memory assumed when that of the host is unknown
+_DEFMEM = 16*1024**3
+
+def defaultcache():
+  """
+  Returns the cache of a worker loop when none is given, bounded
+  to a quarter of the memory of the host so that a long-lived
+  worker does not keep the objects of every job
+  """
+  try:
+    mem = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+  except (ValueError,OSError,AttributeError):
+    mem = _DEFMEM
+  return sharedcache(maxbytes=mem//4)
+
+def objsize(obj):
+  """ Estimates the size of an object from the arrays it contains """
+  if(hasattr(obj,'nbytes')):
+    return obj.nbytes
+  if(isinstance(obj,dict)):
+    return sum([objsize(val) for val in obj.values()])
+  if(isinstance(obj,(list,tuple))):
+    return sum([objsize(val) for val in obj])
+  return sys.getsizeof(obj)
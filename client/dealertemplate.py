@@ -0,0 +1,37 @@
+"""
+A template for a client (worker) that will
+be launched on a cluster and connect to a
+ROUTER server (server.utils.startrouter)
+
+@author: Joseph Jennings
+@version: 2020.09.20
+"""
+import zmq # ZMQ sockets
+from client.worker import dealer_worker, pool_worker, partialsum # Worker loops
+from client.cache import sharedcache # Cache of shared objects
+from comm.relay import relay # Relay for tree broadcasts
+from foo import foo # Function that will do the work
+
+def work(chunk):
+  """ Processes a chunk and returns a dictionary of results """
+  ochunk = {}
+  ochunk['result'] = foo(chunk)
+  # Return other parameters if desired
+  ochunk['other']  = chunk['other']
+  return ochunk
+
+# Connect to socket
+context = zmq.Context()
+socket = context.socket(zmq.DEALER) # this is a "dealer" type ZMQ socket
+socket.connect("tcp://serveraddr:5555")
+
+# Process work keeping two chunks in flight
+dealer_worker(work,socket,credits=2)
+# For dstr_sum, results can instead be summed on the worker
+#dealer_worker(work,socket,credits=2,reducer=partialsum('result'))
+# Process chunks on all the cores of the node (e.g., ncore=48) with a process pool
+#pool_worker(work,socket,nprocs=48)
+# Objects shared by the server are fetched once (bounded cache with local scratch)
+#dealer_worker(work,socket,credits=2,cache=sharedcache(maxbytes=4*1024**3,scratch='/scratch/cache'))
+# With a tree broadcast (broadcaster(fanout=k)), receive and forward through a relay
+#dealer_worker(work,socket,credits=2,cache=sharedcache(relay=relay()))
@@ -0,0 +1,23 @@
+"""
+A template for a generic client (worker) that runs the
+functions shipped by the server (server.pool.workpool).
+The same workers can run successive jobs without being
+relaunched
+
+@author: Joseph Jennings
+@version: 2020.10.18
+"""
+import zmq # ZMQ sockets
+from client.worker import dealer_worker, pool_worker, shipped # Worker loops
+
+# Connect to socket
+context = zmq.Context()
+socket = context.socket(zmq.DEALER) # this is a "dealer" type ZMQ socket
+# The server must use a ROUTER socket (server.utils.startrouter). For a REP
+# server, connect a REQ socket and use req_worker(shipped,socket) instead
+socket.connect("tcp://serveraddr:5555")
+
+# Apply the function of each job (received once and cached by its hash)
+dealer_worker(shipped,socket,credits=2)
+# Process chunks on all the cores of the node with a process pool
+#pool_worker(shipped,socket,nprocs=48)
@@ -0,0 +1,114 @@
+"""
+Functions to launch workers on the server host. The
+workers are forked processes (or threads) that connect
+to the server over ipc:// (or inproc://) instead of TCP
+
+@author: Joseph Jennings
+@version: 2020.10.17
+"""
+import os
+import threading
+import multiprocessing as mp
+import zmq
+from client.worker import req_worker, dealer_worker
+
+def launch_localworkers(func,nworkers=None,address=None,kind='dealer',credits=2,oob=False,
+                        codec=None,reducer=None,cache=None,context=None):
+  """
+  Starts workers on this host that process chunks with func
+
+  Parameters:
+    func     - a function that processes a chunk and returns a dictionary
+    nworkers - the number of workers to start [None, os.cpu_count()]
+    address  - the address of the server socket. With ipc:// (or tcp://) the
+               workers are forked processes. With inproc:// they are threads
+               that connect through the context of the server socket
+               [None, localaddress()]
+    kind     - the type of worker, 'dealer' (ROUTER server) or 'req' (REP server) ['dealer']
+    credits  - number of chunks in flight for each dealer worker [2]
+    oob      - send with out-of-band buffers [False]
+    codec    - name of a codec for the results. With 'shm' the arrays are
+               passed through shared memory segments instead of the socket
+               (use the same codec on the server) [None]
+    reducer  - a function that returns a reducer for each worker
+               (e.g., lambda: partialsum('result')) [None]
+    cache    - a function that returns a cache of shared objects for
+               each worker (e.g., sharedcache) [None]
+    context  - the ZMQ context of the server socket (e.g., returned by
+               server.utils.startrouter), needed with inproc:// [None]
+
+  Returns the address and the list of workers (processes or threads)
+  to be passed to kill_localworkers
+
+  With codec='shm', the segments of the results that the server never
+  receives (e.g., duplicates still in flight at the end of a job with
+  speculate or lease) are released by server.utils.release_results.
+  The segment of a result being sent by a worker that is stopped
+  (kill_localworkers) is left in /dev/shm
+  """
+  if(nworkers is None):
+    nworkers = os.cpu_count()
+  if(address is None):
+    address = localaddress()
+  if(kind not in ('dealer','req')):
+    raise Exception("Worker kind must be 'dealer' or 'req'")
+  inproc = address.startswith("inproc://")
+  if(inproc and context is None):
+    raise Exception("Please provide the context of the server socket for inproc:// workers")
+  args = (func,address,kind,credits,oob,codec,reducer,cache)
+  workers = []
+  for iwrk in range(nworkers):
+    if(inproc):
+      # Threads must share the context of the server
+      wrk = threading.Thread(target=localworker,args=args+(context,),daemon=True)
+    else:
+      wrk = mp.get_context('fork').Process(target=localworker,args=args,daemon=True)
+    wrk.start()
+    workers.append(wrk)
+
+  return address, workers
+
+def localworker(func,address,kind='dealer',credits=2,oob=False,codec=None,reducer=None,
+                cache=None,context=None) -> None:
+  """ Connects to the server and processes chunks (see launch_localworkers) """
+  # A new context is created in a forked process
+  if(context is None):
+    context = zmq.Context.instance()
+  if(kind == 'dealer'):
+    socket = context.socket(zmq.DEALER)
+    socket.connect(address)
+    dealer_worker(func,socket,credits,oob,reducer() if(reducer is not None) else None,codec,
+                  cache() if(cache is not None) else None)
+  else:
+    socket = context.socket(zmq.REQ)
+    socket.connect(address)
+    req_worker(func,socket,oob,True,reducer() if(reducer is not None) else None,codec,
+               cache() if(cache is not None) else None)
+
+def localaddress(name=None):
+  """
+  Returns an ipc:// address for a server and its local workers
+
+  Parameters:
+    name - name of the socket file [None, distrmq-<pid>]
+  """
+  if(name is None):
+    name = "distrmq-%d"%(os.getpid())
+  return "ipc://%s"%(os.path.join(os.environ.get('TMPDIR','/tmp'),name))
+
+def kill_localworkers(workers,timeout=1.0) -> None:
+  """
+  Stops the local worker processes
+
+  Parameters:
+    workers - the list of workers returned by launch_localworkers
+    timeout - time to wait for each worker to exit [1.0 s]
+
+  Threads (inproc://) cannot be killed and are left to exit
+  with the server
+  """
+  for wrk in workers:
+    if(isinstance(wrk,threading.Thread)):
+      continue
+    wrk.terminate()
+    wrk.join(timeout)
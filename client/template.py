@@ -6,32 +6,39 @@ be launched on a cluster
 @version: 2020.08.17
 """
 import zmq # ZMQ sockets
-from comm.sendrecv import notify_server, send_zipped_pickle, recv_zipped_pickle # Comm functions
+from client.worker import req_worker, buffered_worker, partialsum # Worker loops
+from client.cache import sharedcache # Cache of shared objects
+from comm.relay import relay # Relay for tree broadcasts
 from foo import foo # Function that will do the work
 
-# Connect to socket
-context = zmq.Context()
-socket = context.socket(zmq.REQ) # this is a "request" type ZMQ socket
-socket.connect("tcp://serveraddr:5555")
-
-# Listen for work from server
-while True:
-  # Notify we are ready
-  notify_server(socket)
-  # Get work
-  chunk = recv_zipped_pickle(socket)
-  # If chunk is empty, keep listening
-  if(chunk == {}):
-    continue
-  # If I received something, do some work
+def work(chunk):
+  """ Processes a chunk and returns a dictionary of results """
   ochunk = {}
   ochunk['result'] = foo(chunk)
   # Return other parameters if desired
   ochunk['other']  = chunk['other']
-  # Tell server this is the result
-  ochunk['msg'] = "result"
-  # Send back the result
-  send_zipped_pickle(socket,ochunk)
-  # Receive 'thank you'
-  socket.recv()
+  return ochunk
+
+# Connect to socket
+context = zmq.Context()
+socket = context.socket(zmq.REQ) # this is a "request" type ZMQ socket
+socket.connect("tcp://serveraddr:5555")
 
+# Listen for work from server. Set oob=True to send arrays as out-of-band
+# frames or codec='auto' to choose a codec for each frame of the results
+# (codec='adapt' uses the codec tuned by a server with codec='adapt').
+# With piggyback the next chunk is the reply to each result (one round trip per chunk)
+req_worker(work,socket,oob=False,piggyback=True)
+# For dstr_sum, results can instead be summed on the worker
+#req_worker(work,socket,reducer=partialsum('result',nflush=None))
+# Objects shared by the server (server.broadcast) are fetched once and found
+# in chunk[name]. The cache can be bounded and spill to local scratch
+#req_worker(work,socket,cache=sharedcache(maxbytes=4*1024**3,scratch='/scratch/cache'))
+# If the server broadcasts through a tree (broadcaster(fanout=k)), give the cache
+# a relay so that this worker receives and forwards the objects in blocks
+#req_worker(work,socket,cache=sharedcache(relay=relay()))
+# To overlap the transfers with the computation, connect a DEALER socket to a
+# ROUTER server (server.utils.startrouter). A background thread then receives
+# and decodes the next chunk and sends the previous result while work runs
+#socket = context.socket(zmq.DEALER); socket.connect("tcp://serveraddr:5555")
+#buffered_worker(work,socket,credits=2)
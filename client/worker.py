@@ -0,0 +1,502 @@
+"""
+Worker loops to be called within a worker file
+
+@author: Joseph Jennings
+@version: 2020.09.24
+"""
+import os, shutil, tempfile
+import time
+import pickle
+import threading, queue
+import numpy as np
+import zmq
+from comm.sendrecv import notify_server, send_env_pickle, recv_oob_pickle
+from client.cache import sharedcache, defaultcache
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+def send_result(socket,chunk,ochunk,oob=False,nxt=True,codec=None) -> None:
+  """
+  Sends a result back to the server
+
+  Parameters:
+    socket - the ZMQ socket
+    chunk  - the chunk that was processed
+    ochunk - a dictionary containing the result
+    oob    - send with out-of-band buffers [False]
+    nxt    - ask for the next chunk with the result [True]
+    codec  - name of a codec or 'auto' (overrides oob). With
+             'adapt' the codec chosen by the server is used [None]
+  """
+  if(codec == 'adapt'):
+    codec = chunk.get('_codec','auto')
+  # Tell server this is the result
+  ochunk['msg'] = "result"
+  ochunk['next'] = nxt
+  # Return the chunk id (and job) so the server can match the result
+  for key in ('_cid','_job'):
+    if(key in chunk):
+      ochunk[key] = chunk[key]
+  send_env_pickle(socket,ochunk,oob,codec=codec)
+
+def return_result(socket,chunk,ochunk,oob=False,nxt=True,codec=None):
+  """
+  Sends a result back to a REP server and receives the reply
+
+  Parameters:
+    socket - the ZMQ REQ socket
+    chunk  - the chunk that was processed
+    ochunk - a dictionary containing the result
+    oob    - send with out-of-band buffers [False]
+    nxt    - ask for the next chunk with the result [True]
+    codec  - name of a codec or 'auto' (overrides oob) [None]
+
+  Returns the next chunk (an empty dictionary if no work or
+  if nxt is False)
+  """
+  send_result(socket,chunk,ochunk,oob,nxt,codec)
+  if(nxt):
+    # Receive the next chunk
+    return recv_oob_pickle(socket)
+  # Receive 'thank you'
+  socket.recv()
+  return {}
+
+def timed(func,chunk):
+  """ Applies func to a chunk and saves the compute time in the result """
+  if(chunk.get('_stale',False)):
+    # A chunk of a job that is over (the result is discarded by the server)
+    return {'_stale': True, '_tcmp': 0.0}
+  beg = time.time()
+  ochunk = func(chunk)
+  ochunk['_tcmp'] = time.time() - beg
+  return ochunk
+
+def process(func,chunk):
+  """
+  Applies func to a chunk or to each chunk of a batch
+  ({'_batch': [chunks]}). The results of a batch are
+  returned in a single batch result
+  """
+  if('_batch' not in chunk):
+    return timed(func,chunk)
+  ochunks = []
+  for ichunk in chunk['_batch']:
+    ochunk = timed(func,ichunk)
+    ochunk['_cid'] = ichunk.get('_cid')
+    # The job is also needed to sum the result on an aggregator
+    if('_job' in ichunk):
+      ochunk['_job'] = ichunk['_job']
+    ochunks.append(ochunk)
+  return {'_batch': ochunks, '_cids': [ochunk['_cid'] for ochunk in ochunks],
+          '_tcmp': sum([ochunk['_tcmp'] for ochunk in ochunks])}
+
+# Functions shipped by the server (by hash, the most recently used)
+_shipped = OrderedDict()
+_NSHIPPED = 8
+
+def shipped(chunk):
+  """
+  Applies the function shipped by the server (server.pool) to a
+  chunk. Used as the function of a generic worker, e.g.,
+  dealer_worker(shipped,socket). Each function is unpickled once
+  and the least recently used ones are dropped
+  """
+  payload = chunk.pop('_func',None)
+  if(payload is None):
+    raise Exception("No function was shipped with the chunk (see server.pool)")
+  hsh = chunk.get('_refs',{}).get('_func')
+  func = _shipped.get(hsh)
+  if(func is None):
+    func = pickle.loads(payload)
+    if(hsh is None):
+      return func(chunk)
+    _shipped[hsh] = func
+    while(len(_shipped) > _NSHIPPED):
+      _shipped.popitem(last=False)
+  _shipped.move_to_end(hsh)
+  return func(chunk)
+
+# Cache of the shared objects in a process of a pool_worker
+_pooled = None
+
+def pooltask(func,chunk,scratch,maxbytes=None):
+  """
+  Processes a chunk in a process of a pool_worker. The shared
+  objects are loaded from scratch once per process
+  """
+  global _pooled
+  if(_pooled is None):
+    _pooled = sharedcache(maxbytes,scratch)
+  return process(func,_pooled.resolve(chunk,None))
+
+def reduce_result(reducer,chunk,ochunk) -> None:
+  """ Adds the result of a chunk (or of each chunk of a batch) to a reducer """
+  if('_batch' not in chunk):
+    reducer.add(chunk,ochunk)
+    return
+  for ichunk,iochunk in zip(chunk['_batch'],ochunk['_batch']):
+    reducer.add(ichunk,iochunk)
+
+def chunk_ids(chunk):
+  """ Returns the id (or list of ids of a batch) of a chunk """
+  if('_batch' in chunk):
+    return [ichunk.get('_cid') for ichunk in chunk['_batch']]
+  return chunk.get('_cid')
+
+def req_worker(func,socket,oob=False,piggyback=True,reducer=None,codec=None,cache=None) -> None:
+  """
+  Processes chunks from a REP server with a REQ socket
+
+  Parameters:
+    func      - a function that takes a chunk and returns
+                a dictionary of results
+    socket    - a connected ZMQ REQ socket
+    oob       - send with out-of-band buffers [False]
+    piggyback - receive the next chunk as the reply to
+                each result (one round trip per chunk) [True]
+    reducer   - keep a partial sum of the results on the worker
+                (a partialsum, only with dstr_sum) [None]
+    codec     - name of a codec for the results, 'auto' or 'adapt'
+                (the codec chosen by the server, overrides oob) [None]
+    cache     - a sharedcache of the objects shared by the server
+                (server.broadcast) [None, client.cache.defaultcache()]
+  """
+  ncodec = 'auto' if(codec == 'adapt') else codec
+  if(cache is None): cache = defaultcache()
+  chunk = {}
+  while True:
+    if(chunk == {}):
+      if(reducer is not None and not reducer.empty()):
+        # No more work, return the partial result
+        chunk = return_result(socket,{},reducer.flush(),oob,piggyback,codec)
+      else:
+        # Notify we are ready and get work
+        notify_server(socket,oob,codec=ncodec)
+        chunk = recv_oob_pickle(socket)
+      # If chunk is empty, keep listening
+      continue
+    # If I received something, do some work
+    chunk = cache.resolve(chunk,socket,oob)
+    ochunk = process(func,chunk)
+    if(reducer is None):
+      chunk = return_result(socket,chunk,ochunk,oob,piggyback,codec)
+    else:
+      reduce_result(reducer,chunk,ochunk)
+      if(reducer.full()):
+        chunk = return_result(socket,{},reducer.flush(),oob,piggyback,codec)
+      else:
+        notify_server(socket,oob,chunk_ids(chunk),ncodec,chunk.get('_job'))
+        chunk = recv_oob_pickle(socket)
+
+def dealer_worker(func,socket,credits=2,oob=False,reducer=None,codec=None,cache=None) -> None:
+  """
+  Processes chunks from a ROUTER server with a DEALER
+  socket. The worker keeps credits chunks in flight so the
+  next chunk is already received while the current
+  one is being processed
+
+  Parameters:
+    func    - a function that takes a chunk and returns
+              a dictionary of results
+    socket  - a connected ZMQ DEALER socket
+    credits - number of chunks to keep in flight [2]
+    oob     - send with out-of-band buffers [False]
+    reducer - keep a partial sum of the results on the worker
+              (a partialsum, only with dstr_sum) [None]
+    codec   - name of a codec for the results, 'auto' or 'adapt'
+              (the codec chosen by the server, overrides oob) [None]
+    cache   - a sharedcache of the objects shared by the server
+              (server.broadcast) [None, client.cache.defaultcache()]
+  """
+  ncodec = 'auto' if(codec == 'adapt') else codec
+  if(cache is None): cache = defaultcache()
+  # Chunks received while fetching a shared object
+  stash = deque()
+  # Ask for as many chunks as we have credits
+  for icrd in range(credits):
+    notify_server(socket,oob,codec=ncodec)
+  while True:
+    # Get work
+    chunk = stash.popleft() if(len(stash) > 0) else recv_oob_pickle(socket)
+    if(chunk == {}):
+      if(reducer is not None and not reducer.empty()):
+        # No more work, return the partial result
+        send_result(socket,{},reducer.flush(),oob,codec=codec)
+      else:
+        # Nothing to do for now, ask again
+        notify_server(socket,oob,codec=ncodec)
+      continue
+    # Do the work and return the credit with the result
+    chunk = cache.resolve(chunk,socket,oob,stash)
+    ochunk = process(func,chunk)
+    if(reducer is None):
+      send_result(socket,chunk,ochunk,oob,codec=codec)
+    else:
+      reduce_result(reducer,chunk,ochunk)
+      if(reducer.full()):
+        send_result(socket,{},reducer.flush(),oob,codec=codec)
+      else:
+        notify_server(socket,oob,chunk_ids(chunk),ncodec,chunk.get('_job'))
+
+def pool_worker(func,socket,nprocs=None,extra=1,oob=False,reducer=None,codec=None,
+                cache=None) -> None:
+  """
+  Processes chunks from a ROUTER server with a DEALER socket
+  and a pool of nprocs processes on the node. The worker keeps
+  enough chunks in flight to keep all processes busy and
+  returns each result as soon as it is done
+
+  Parameters:
+    func    - a function that takes a chunk and returns a dictionary
+              of results (must be picklable, e.g., defined at the top
+              level of the worker file)
+    socket  - a connected ZMQ DEALER socket
+    nprocs  - number of processes in the pool [None, os.cpu_count()]
+    extra   - number of chunks in flight beyond nprocs (received
+              while all processes are busy) [1]
+    oob     - send with out-of-band buffers [False]
+    reducer - keep a partial sum of the results on the worker
+              (a partialsum, only with dstr_sum) [None]
+    codec   - name of a codec for the results, 'auto' or 'adapt'
+              (the codec chosen by the server, overrides oob) [None]
+    cache   - a sharedcache of the objects shared by the server
+              (server.broadcast) [None, client.cache.defaultcache()]
+
+  The chunks are passed to the processes with the references of the
+  shared objects. Each object is saved once on the scratch directory
+  of the cache (a temporary directory without scratch, removed when the
+  loop exits) and each process loads it once into a cache of its own
+  (bounded by the size of cache)
+  """
+  if(nprocs is None): nprocs = os.cpu_count()
+  ncodec = 'auto' if(codec == 'adapt') else codec
+  if(cache is None): cache = defaultcache()
+  scratch = cache.scratch
+  if(scratch is None):
+    scratch = tempfile.mkdtemp(prefix='distrmq-pool-')
+  stash = deque()
+  # Woken up by the pool when a chunk is done
+  wakeaddr = "inproc://pool-%x"%(id(socket))
+  wake = socket.context.socket(zmq.PULL)
+  wake.bind(wakeaddr)
+  def woken(future):
+    push = socket.context.socket(zmq.PUSH)
+    push.connect(wakeaddr)
+    push.send(b"",copy=False)
+    push.close(linger=-1)
+  poller = zmq.Poller()
+  poller.register(socket,zmq.POLLIN)
+  poller.register(wake,zmq.POLLIN)
+  # Chunks being processed (in the order they were submitted)
+  running = deque()
+  # The server has no more work (sent once)
+  ended = False
+  try:
+    with ProcessPoolExecutor(nprocs) as pool:
+      # Ask for as many chunks as the pool can hold
+      for icrd in range(nprocs + extra):
+        notify_server(socket,oob,codec=ncodec)
+      while True:
+        socks = dict(poller.poll()) if(len(stash) == 0) else {socket: zmq.POLLIN}
+        if(wake in socks):
+          wake.recv()
+        # Return the results that are done
+        left = deque()
+        for chunk,future in running:
+          if(not future.done()):
+            left.append((chunk,future))
+            continue
+          ochunk = future.result()
+          if(reducer is None):
+            send_result(socket,chunk,ochunk,oob,codec=codec)
+          else:
+            reduce_result(reducer,chunk,ochunk)
+            # Chunks done after the end of work are returned right away
+            if(reducer.full() or ended):
+              send_result(socket,{},reducer.flush(),oob,codec=codec)
+            else:
+              notify_server(socket,oob,chunk_ids(chunk),ncodec,chunk.get('_job'))
+        running = left
+        if(socket not in socks):
+          continue
+        # Get work
+        chunk = stash.popleft() if(len(stash) > 0) else recv_oob_pickle(socket)
+        ended = (chunk == {})
+        if(chunk == {}):
+          if(reducer is not None and not reducer.empty()):
+            # No more work, return the partial result
+            send_result(socket,{},reducer.flush(),oob,codec=codec)
+          else:
+            # Nothing to do for now, ask again
+            notify_server(socket,oob,codec=ncodec)
+          continue
+        # The processes load the shared objects from scratch (not through the pipe)
+        chunk = cache.export(chunk,socket,scratch,oob,stash)
+        future = pool.submit(pooltask,func,chunk,scratch,cache.maxbytes)
+        running.append((chunk,future))
+        future.add_done_callback(woken)
+  finally:
+    if(cache.scratch is None):
+      shutil.rmtree(scratch,ignore_errors=True)
+
+def buffered_worker(func,socket,credits=2,oob=False,reducer=None,codec=None,cache=None) -> None:
+  """
+  Processes chunks from a ROUTER server with a DEALER socket,
+  overlapping the communication with the computation. A
+  background thread receives and decodes the next chunks and
+  encodes and sends the previous results while func computes
+  the current chunk
+
+  Parameters:
+    func    - a function that takes a chunk and returns
+              a dictionary of results
+    socket  - a connected ZMQ DEALER socket (only used by the
+              background thread)
+    credits - number of chunks to keep in flight [2]
+    oob     - send with out-of-band buffers [False]
+    reducer - keep a partial sum of the results on the worker
+              (a partialsum, only with dstr_sum) [None]
+    codec   - name of a codec for the results, 'auto' or 'adapt'
+              (the codec chosen by the server, overrides oob) [None]
+    cache   - a sharedcache of the objects shared by the server
+              (server.broadcast) [None, client.cache.defaultcache()]
+  """
+  ncodec = 'auto' if(codec == 'adapt') else codec
+  if(cache is None): cache = defaultcache()
+  # Decoded chunks and messages to be sent
+  inq,outq = queue.Queue(),queue.Queue()
+  wakeaddr = "inproc://buffered-%x"%(id(socket))
+  wake = socket.context.socket(zmq.PULL)
+  wake.bind(wakeaddr)
+  thread = threading.Thread(target=ioloop,args=(socket,wake,inq,outq,credits,oob,ncodec,cache),
+                            daemon=True)
+  thread.start()
+  push = socket.context.socket(zmq.PUSH)
+  push.connect(wakeaddr)
+  def post(msg,*args):
+    outq.put((msg,args))
+    push.send(b"",copy=False)
+  while True:
+    # Get work (already decoded)
+    chunk = inq.get()
+    if(chunk == {}):
+      if(reducer is not None and not reducer.empty()):
+        # No more work, return the partial result
+        post('result',{},reducer.flush(),codec)
+      else:
+        # Nothing to do for now, ask again
+        post('notify',None,None)
+      continue
+    ochunk = process(func,chunk)
+    if(reducer is None):
+      post('result',chunk,ochunk,codec)
+    else:
+      reduce_result(reducer,chunk,ochunk)
+      if(reducer.full()):
+        post('result',{},reducer.flush(),codec)
+      else:
+        post('notify',chunk_ids(chunk),chunk.get('_job'))
+
+def ioloop(socket,wake,inq,outq,credits=2,oob=False,ncodec=None,cache=None) -> None:
+  """
+  Receives and decodes the chunks and sends the messages
+  of a buffered_worker (background thread)
+  """
+  # Chunks received while fetching a shared object
+  stash = deque()
+  # Ask for as many chunks as we have credits
+  for icrd in range(credits):
+    notify_server(socket,oob,codec=ncodec)
+  poller = zmq.Poller()
+  poller.register(socket,zmq.POLLIN)
+  poller.register(wake,zmq.POLLIN)
+  while True:
+    socks = dict(poller.poll())
+    if(wake in socks):
+      wake.recv()
+      msg,args = outq.get()
+      if(msg == 'result'):
+        chunk,ochunk,codec = args
+        send_result(socket,chunk,ochunk,oob,codec=codec)
+      else:
+        notify_server(socket,oob,args[0],ncodec,args[1])
+    if(socket in socks):
+      stash.append(recv_oob_pickle(socket))
+      while(len(stash) > 0):
+        chunk = stash.popleft()
+        if(chunk != {}):
+          chunk = cache.resolve(chunk,socket,oob,stash)
+        inq.put(chunk)
+
+class partialsum:
+  """
+  Sums the results of several chunks on the worker
+  so that only the sum is returned to dstr_sum
+  """
+
+  def __init__(self,rkey,ikey='idx',nflush=None):
+    """
+    partialsum constructor
+
+    Parameters:
+      rkey   - the result key to be summed
+      ikey   - key for the index for chunked transfer ['idx']
+               (results with different indices are summed separately)
+      nflush - return the partial sum every nflush chunks
+               [None, only when there is no more work]
+    """
+    self.rkey   = rkey
+    self.ikey   = ikey
+    self.nflush = nflush
+    self.sums   = {}
+    self.cids   = []
+    self.job    = None
+
+  def add(self,chunk,ochunk) -> None:
+    """ Adds the result of a chunk to the partial sum """
+    if(ochunk.get('_stale',False)):
+      return
+    self.start(chunk.get('_job'))
+    idx = ochunk.get(self.ikey)
+    if(idx in self.sums):
+      self.sums[idx] += ochunk[self.rkey]
+    else:
+      self.sums[idx] = np.array(ochunk[self.rkey])
+    self.cids.append(chunk.get('_cid'))
+
+  def merge(self,ochunk) -> None:
+    """ Adds a partial result (returned by flush) to the partial sum """
+    self.start(ochunk.get('_job'))
+    for idx,res in ochunk[self.rkey].items():
+      if(idx in self.sums):
+        self.sums[idx] += res
+      else:
+        self.sums[idx] = np.array(res)
+    self.cids += ochunk['_cids']
+
+  def start(self,job) -> None:
+    """
+    Starts a new sum for the results of a new job. The sum of
+    a previous job (no longer wanted by the server) is discarded.
+    Results without a job id are added to the current sum
+    """
+    if(job is not None and job != self.job):
+      self.sums = {}; self.cids = []
+      self.job = job
+
+  def empty(self):
+    """ Checks if there is nothing to return """
+    return len(self.cids) == 0
+
+  def full(self):
+    """ Checks if the partial sum should be returned """
+    return self.nflush is not None and len(self.cids) >= self.nflush
+
+  def flush(self):
+    """ Returns the partial result and resets the sum """
+    ochunk = {self.rkey: self.sums, '_cids': self.cids, '_partial': True}
+    if(self.job is not None):
+      ochunk['_job'] = self.job
+    self.sums = {}; self.cids = []
+    return ochunk
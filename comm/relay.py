@@ -0,0 +1,242 @@
+"""
+Relays of shared objects in pipelined blocks so that an
+object can be broadcast through a tree of workers
+
+@author: Joseph Jennings
+@version: 2020.10.12
+"""
+import socket as pysocket
+import threading, queue
+import time
+import pickle
+import zmq
+
+class relay:
+  """
+  Serves the encoded frames of objects in blocks (ROUTER socket)
+  and pulls objects block by block from another relay (its parent).
+  A block is forwarded to the children as soon as it is received
+  so that the transfers down a tree of relays are pipelined.
+  All sockets are used in a background thread
+
+  An object is served until it is unpublished. Its children are then
+  told it is missing (and fall back to fetching it from the server)
+  """
+
+  def __init__(self,address=None,host=None,blocksize=4*1024**2,window=4,timeout=60.0):
+    """
+    relay constructor
+
+    Parameters:
+      address   - the address to which the relay binds
+                  [None, a random port on all interfaces]
+      host      - the host name given to the children [socket.gethostname()]
+      blocksize - size of the blocks of the published objects in bytes. An
+                  object pulled from a parent keeps the block size of
+                  the parent (sent with each block) [4 MB]
+      window    - number of blocks requested ahead from the parent [4]
+      timeout   - give up pulling an object if no block is received
+                  from the parent within timeout seconds [60.0]
+    """
+    self.blocksize = blocksize
+    self.window    = window
+    self.timeout   = timeout
+    # Objects (complete or being pulled) and objects no longer served
+    self.blobs   = {}
+    self.dropped = set()
+    self.cmds    = queue.Queue()
+    self.context = zmq.Context.instance()
+    self.wake    = "inproc://relay-%x"%(id(self))
+    bound = queue.Queue()
+    self.thread = threading.Thread(target=self.run,args=(address,bound),daemon=True)
+    self.thread.start()
+    port = bound.get()
+    if(host is None): host = pysocket.gethostname()
+    self.address = "tcp://%s:%d"%(host,port)
+
+  def publish(self,hsh,frames) -> None:
+    """
+    Makes the encoded frames of an object available to the children.
+    The frames are served as they are (not copied) and must not be
+    changed until the object is unpublished
+    """
+    self.command(('publish',hsh,frames))
+
+  def unpublish(self,hsh) -> None:
+    """ Frees an object (published or pulled) and stops serving it """
+    self.command(('unpublish',hsh))
+
+  def pull(self,hsh,parent):
+    """
+    Pulls an object from a parent relay (and serves it to the
+    children while it is received)
+
+    Parameters:
+      hsh    - the hash of the object
+      parent - the address of the parent relay
+
+    Returns the frames of the object (None if the parent was lost)
+    """
+    done = threading.Event()
+    self.command(('pull',hsh,parent,done))
+    done.wait()
+    blob = self.blobs.get(hsh)
+    if(blob is None or blob['have'] < blob['nblocks']):
+      return None
+    return splitframes(blob)
+
+  def command(self,cmd) -> None:
+    """ Queues a command and wakes the relay thread """
+    self.cmds.put(cmd)
+    wake = self.context.socket(zmq.PUSH)
+    wake.connect(self.wake)
+    wake.send(b"",copy=False)
+    wake.close(linger=-1)
+
+  def run(self,address,bound) -> None:
+    """ Serves and pulls blocks (background thread) """
+    wake = self.context.socket(zmq.PULL)
+    wake.bind(self.wake)
+    rtr = self.context.socket(zmq.ROUTER)
+    if(address is None):
+      port = rtr.bind_to_random_port("tcp://*")
+    else:
+      rtr.bind(address)
+      port = int(address.rsplit(":",1)[1])
+    bound.put(port)
+    poller = zmq.Poller()
+    poller.register(wake,zmq.POLLIN)
+    poller.register(rtr,zmq.POLLIN)
+    # Requests of blocks not yet received and pulls in progress
+    self.waiting = {}
+    self.pulls   = {}
+    while True:
+      socks = dict(poller.poll(1000))
+      if(wake in socks):
+        wake.recv()
+        self.docommand(poller)
+      if(rtr in socks):
+        wid,hsh,iblock = rtr.recv_multipart()
+        self.waiting.setdefault(hsh.decode(),[]).append((wid,int(iblock)))
+      for hsh,pull in list(self.pulls.items()):
+        if(pull['sock'] in socks):
+          self.receive(hsh,pull,poller)
+        elif(time.time() - pull['last'] > self.timeout):
+          # The parent was lost
+          self.endpull(hsh,pull,poller)
+      self.serve(rtr)
+
+  def docommand(self,poller) -> None:
+    """ Executes a command of the main thread """
+    cmd = self.cmds.get()
+    if(cmd[0] == 'publish'):
+      hsh,frames = cmd[1:]
+      bufs = [memoryview(getattr(frame,'buffer',frame)).cast('B') for frame in frames]
+      sizes = [len(buf) for buf in bufs]
+      nblocks = self.nblocks(sum(sizes),self.blocksize)
+      self.blobs[hsh] = {'bufs': bufs, 'sizes': sizes, 'blocksize': self.blocksize,
+                         'nblocks': nblocks, 'have': nblocks}
+      self.dropped.discard(hsh)
+    elif(cmd[0] == 'unpublish'):
+      hsh = cmd[1]
+      self.blobs.pop(hsh,None)
+      self.dropped.add(hsh)
+    elif(cmd[0] == 'pull'):
+      hsh,parent,done = cmd[1:]
+      blob = self.blobs.get(hsh)
+      if(blob is not None and blob['have'] == blob['nblocks']):
+        done.set()
+        return
+      sock = self.context.socket(zmq.DEALER)
+      sock.connect(parent)
+      poller.register(sock,zmq.POLLIN)
+      # Ask for the first block (gives the size of the object)
+      sock.send_multipart([hsh.encode(),b"0"])
+      self.pulls[hsh] = {'sock': sock, 'next': 1, 'done': done, 'last': time.time()}
+
+  def receive(self,hsh,pull,poller) -> None:
+    """ Receives a block from the parent """
+    rhsh,iblock,header,data = pull['sock'].recv_multipart(copy=False)
+    iblock = int(iblock.bytes)
+    pull['last'] = time.time()
+    if(iblock < 0):
+      # The parent no longer has the object
+      self.endpull(hsh,pull,poller)
+      return
+    blob = self.blobs.get(hsh)
+    if(blob is None):
+      nbytes,sizes,blocksize = pickle.loads(header.bytes)
+      blob = {'bufs': [memoryview(bytearray(nbytes))], 'sizes': sizes, 'blocksize': blocksize,
+              'nblocks': self.nblocks(nbytes,blocksize), 'have': 0}
+      self.blobs[hsh] = blob
+      self.dropped.discard(hsh)
+    beg = iblock*blob['blocksize']
+    blob['bufs'][0][beg:beg+len(data.buffer)] = data.buffer
+    blob['have'] = iblock + 1
+    if(blob['have'] == blob['nblocks']):
+      self.endpull(hsh,pull,poller)
+      return
+    # Keep window blocks in flight
+    while(pull['next'] < min(blob['have'] + self.window,blob['nblocks'])):
+      pull['sock'].send_multipart([hsh.encode(),str(pull['next']).encode()])
+      pull['next'] += 1
+
+  def endpull(self,hsh,pull,poller) -> None:
+    """ Ends the pull of an object """
+    poller.unregister(pull['sock'])
+    pull['sock'].close(linger=0)
+    del self.pulls[hsh]
+    blob = self.blobs.get(hsh)
+    if(blob is not None and blob['have'] < blob['nblocks']):
+      # Incomplete objects are not served
+      del self.blobs[hsh]
+    pull['done'].set()
+
+  def serve(self,rtr) -> None:
+    """ Sends the blocks that are available to the children """
+    for hsh,reqs in list(self.waiting.items()):
+      blob = self.blobs.get(hsh)
+      if(blob is None and hsh in self.dropped):
+        # Tell the children the object is missing
+        for wid,iblock in reqs:
+          rtr.send_multipart([wid,hsh.encode(),b"-1",b"",b""])
+        del self.waiting[hsh]
+        continue
+      if(blob is None): continue
+      # The header gives the layout of the object to the children
+      header = pickle.dumps((sum(blob['sizes']),blob['sizes'],blob['blocksize']))
+      left = []
+      for wid,iblock in reqs:
+        if(iblock < blob['have']):
+          beg = iblock*blob['blocksize']
+          rtr.send_multipart([wid,hsh.encode(),str(iblock).encode(),header,
+                              readblock(blob,beg,beg+blob['blocksize'])],copy=False)
+        else:
+          left.append((wid,iblock))
+      self.waiting[hsh] = left
+
+  def nblocks(self,nbytes,blocksize):
+    """ Returns the number of blocks of an object """
+    return max(-(-nbytes//blocksize),1)
+
+def readblock(blob,beg,end):
+  """ Returns the bytes [beg,end) of an object (copied only if they span several frames) """
+  parts,off = [],0
+  for buf in blob['bufs']:
+    if(off < end and off + len(buf) > beg):
+      parts.append(buf[max(beg-off,0):min(end-off,len(buf))])
+    off += len(buf)
+  if(len(parts) == 1):
+    return parts[0]
+  return b"".join(parts)
+
+def splitframes(blob):
+  """ Returns the frames of a complete object """
+  if(len(blob['bufs']) == len(blob['sizes'])):
+    return list(blob['bufs'])
+  frames,beg = [],0
+  buf = blob['bufs'][0]
+  for size in blob['sizes']:
+    frames.append(buf[beg:beg+size])
+    beg += size
+  return frames
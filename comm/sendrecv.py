@@ -8,34 +8,85 @@ sockets using zmq
 import pickle
 import zlib, lz4.frame
 import types
+import mmap, weakref
+import numpy as np
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+try:
+  from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+  shared_memory = None
 
-def send_next_chunk(socket,gen,zlevel=-1):
+# Tag frame identifying a message with out-of-band buffers
+_OOBTAG = b"oob"
+# Tag frame identifying a message with a control envelope
+_ENVTAG = b"env"
+# Keys of a result sent in the control envelope
+_CTLKEYS = ['msg','next','_cid','_cids','_job','_partial','_tcmp']
+# Tag frame identifying a message with a codec header
+_CDCTAG = b"cdc"
+# Frames smaller than this are not compressed by the auto codec
+_MINZBYTES = 1024
+# Frames smaller than this are sent inline by the shm codec
+_MINSHMBYTES = 64*1024
+# Codecs that need an optional package
+_OPTCODECS = {'zstd': 'zstandard', 'shm': 'Python 3.8 or later (multiprocessing.shared_memory)'}
+
+def send_next_chunk(socket,gen,zlevel=-1,oob=False,codec=None):
   """
   Sends the next chunk to the workers
 
   Parameters:
-    gen - a generator that returns the next chunk
+    gen    - a generator that returns the next chunk
+    zlevel - level of compression [-1]
+    oob    - send with out-of-band buffers (no compression) [False]
+    codec  - name of a codec or 'auto' (overrides zlevel and oob) [None]
   """
   if(isinstance(gen,types.GeneratorType)):
     try:
       chunk = next(gen)
-      send_zipped_pickle(socket,chunk,zlevel)
     except StopIteration:
       chunk = {}
-      send_zipped_pickle(socket,chunk)
+    send_chunk(socket,chunk,zlevel,oob,codec)
   else:
     raise Exception("Please provide a valid generator as input")
 
-def notify_server(socket):
+def send_chunk(socket,chunk,zlevel=-1,oob=False,codec=None):
+  """
+  Sends a chunk to a worker
+
+  Parameters:
+    chunk  - the chunk to send (an empty dictionary if no work)
+    zlevel - level of compression [-1]
+    oob    - send with out-of-band buffers (no compression) [False]
+    codec  - name of a codec or 'auto' (overrides zlevel and oob) [None]
+  """
+  frames = dumps_frames(chunk,oob,zlevel,codec=codec)
+  socket.send_multipart(frames, copy=False)
+
+def notify_server(socket,oob=False,cid=None,codec=None,job=None):
   """
   Notifies a server that the client is ready
   for data and computation
 
   Parameters:
     socket - the ZMQ socket
+    oob    - send with out-of-band buffers [False]
+    cid    - id (or list of ids) of finished chunks whose results
+             are kept on the worker (partial reduction) [None]
+    codec  - name of a codec or 'auto' (overrides oob) [None]
+    job    - id of the job of the chunks cid [None]
   """
   mydict = dict({'msg': "available"})
-  send_zipped_pickle(socket,mydict)
+  if(isinstance(cid,list)):
+    mydict['_cids'] = cid
+  elif(cid is not None):
+    mydict['_cid'] = cid
+  if(job is not None):
+    mydict['_job'] = job
+  socket.send_multipart(dumps_frames(mydict,oob,codec=codec), copy=False)
 
 def send_zipped_pickle(socket, obj, zlevel=-1, protocol=-1, flags=0):
   """pickle an object, and zip the pickle before sending it"""
@@ -49,3 +100,325 @@ def recv_zipped_pickle(socket, flags=0):
   p = lz4.frame.decompress(z)
   return pickle.loads(p)
 
+def dumps_frames(obj, oob=False, zlevel=-1, protocol=-1, codec=None, info=None):
+  """
+  Serializes an object into a list of message frames
+
+  Parameters:
+    obj      - the object to be serialized
+    oob      - use pickle protocol 5 out-of-band buffers [False]
+    zlevel   - level of compression (only if not oob) [-1]
+    protocol - pickle protocol (only if not oob) [-1]
+    codec    - name of a registered codec used for all frames
+               or 'auto' to select one per frame (overrides
+               zlevel and oob) [None]
+    info     - a dictionary in which the size of the message before
+               ('raw') and after ('nbytes') encoding is saved [None]
+
+  Returns a list of frames. Without oob this is a single lz4
+  compressed pickle. With oob the frames are a tag, the pickle
+  and then the raw memory of each buffer (e.g., numpy arrays)
+  which is never copied. With a codec, the pickle and buffers
+  are each encoded and a header records the codec of each frame
+  """
+  if(codec is not None):
+    bufs = []
+    p = pickle.dumps(obj, protocol=5, buffer_callback=bufs.append)
+    frames = [memoryview(p)] + [buf.raw() for buf in bufs]
+    metas  = [memoryview(p)] + [memoryview(buf) for buf in bufs]
+    names,oframes = [],[]
+    for frame,meta in zip(frames,metas):
+      name = select_codec(meta) if(codec == 'auto') else codec
+      enc,dec = get_codec(name)
+      names.append("%s/%d"%(name,meta.itemsize))
+      oframes.append(enc(frame,meta.itemsize))
+    if(info is not None):
+      info['raw'] = sum([meta.nbytes for meta in metas])
+      info['nbytes'] = nbytes(oframes)
+    return [_CDCTAG, ",".join(names).encode()] + oframes
+  if(oob):
+    bufs = []
+    p = pickle.dumps(obj, protocol=5, buffer_callback=bufs.append)
+    frames = [_OOBTAG, p] + [buf.raw() for buf in bufs]
+    if(info is not None):
+      info['raw'] = info['nbytes'] = nbytes(frames[1:])
+    return frames
+  else:
+    p = pickle.dumps(obj, protocol)
+    z = lz4.frame.compress(p,compression_level=zlevel)
+    if(info is not None):
+      info['raw'] = len(p); info['nbytes'] = len(z)
+    return [z]
+
+def nbytes(frames):
+  """ Returns the total number of bytes in a list of frames """
+  return sum([memoryview(_framebuf(frame)).nbytes for frame in frames])
+
+def loads_frames(frames):
+  """
+  Inverse of dumps_frames. Works with zmq.Frame objects
+  (received with copy=False) or with bytes
+
+  Parameters:
+    frames - a list of message frames
+
+  Returns the deserialized object. Out-of-band arrays are
+  rebuilt directly over the frame memory (without a copy).
+  The decoded arrays can always be written to (read-only
+  frames, e.g. bytes, are copied)
+  """
+  frames = [_framebuf(frame) for frame in frames]
+  if(len(frames) == 1):
+    return pickle.loads(lz4.frame.decompress(frames[0]))
+  elif(frames[0] == _OOBTAG):
+    return pickle.loads(frames[1], buffers=[_writable(frame) for frame in frames[2:]])
+  elif(frames[0] == _ENVTAG):
+    obj = loads_frames(frames[2:])
+    obj.update(pickle.loads(frames[1]))
+    return obj
+  elif(frames[0] == _CDCTAG):
+    dframes = []
+    for name,frame in zip(bytes(frames[1]).decode().split(","),frames[2:]):
+      name,itemsize = name.split("/")
+      enc,dec = get_codec(name)
+      dframes.append(_writable(dec(frame,int(itemsize))))
+    return pickle.loads(dframes[0], buffers=dframes[1:])
+  else:
+    raise Exception("Unknown message format")
+
+def loads_ctl(frames):
+  """
+  Reads only the control envelope of a message
+  (see send_env_pickle) without decoding the rest
+
+  Parameters:
+    frames - a list of message frames
+
+  Returns the control dictionary and a flag indicating if
+  it is the whole message. Messages without an envelope are
+  decoded completely
+  """
+  if(len(frames) > 1 and _framebuf(frames[0]) == _ENVTAG):
+    return pickle.loads(_framebuf(frames[1])), False
+  return loads_frames(frames), True
+
+def send_env_pickle(socket, obj, oob=False, zlevel=-1, flags=0, codec=None):
+  """
+  Sends a dictionary with its control keys (e.g., 'msg' and 'next')
+  in a small uncompressed envelope frame so that the receiver can act
+  on them before (or without) decoding the rest of the message
+  """
+  ctl,obj = {},dict(obj)
+  for key in _CTLKEYS:
+    if(key in obj): ctl[key] = obj.pop(key)
+  frames = [_ENVTAG, pickle.dumps(ctl)] + dumps_frames(obj,oob,zlevel,codec=codec)
+  return socket.send_multipart(frames, flags=flags, copy=False)
+
+def send_oob_pickle(socket, obj, flags=0):
+  """
+  Pickle an object with out-of-band buffers and send the
+  buffers as separate frames without copying them
+  """
+  return socket.send_multipart(dumps_frames(obj,oob=True), flags=flags, copy=False)
+
+def recv_oob_pickle(socket, flags=0):
+  """
+  Inverse of send_oob_pickle. Also accepts a message
+  sent with send_zipped_pickle
+  """
+  frames = socket.recv_multipart(flags, copy=False)
+  return loads_frames(frames)
+
+def release_frames(frames) -> None:
+  """
+  Frees the resources held by a message that is not decoded
+  (e.g., the shared memory segments of the shm codec of a
+  discarded duplicate result)
+
+  Parameters:
+    frames - a list of message frames
+  """
+  for name,frame in _codecframes(frames):
+    if(name in _releases):
+      _releases[name](frame)
+
+def needs_decode(frames):
+  """
+  Checks if a message holds resources outside of its frames
+  that are only freed when it is decoded (e.g., codec 'shm').
+  Such a message must be decoded (or released) exactly once
+  """
+  return any([name in _releases for name,frame in _codecframes(frames)])
+
+def _codecframes(frames):
+  """ Returns the codec name and the encoded frame of each frame of a message """
+  frames = [_framebuf(frame) for frame in frames]
+  if(len(frames) > 2 and frames[0] == _ENVTAG):
+    frames = frames[2:]
+  if(len(frames) < 2 or frames[0] != _CDCTAG):
+    return []
+  names = [name.split("/")[0] for name in bytes(frames[1]).decode().split(",")]
+  return list(zip(names,frames[2:]))
+
+def _writable(buf):
+  """ Returns buf if it can be written to (a copy otherwise) """
+  view = memoryview(buf)
+  return view if(not view.readonly) else bytearray(view)
+
+def _framebuf(frame):
+  """ Returns the memory of a frame without copying it """
+  if(hasattr(frame,'buffer')):
+    return frame.buffer
+  return frame
+
+def register_codec(name,encode,decode,release=None) -> None:
+  """
+  Registers a codec that can be used for sending messages
+
+  Parameters:
+    name    - name of the codec (recorded in the message header)
+    encode  - a function encode(buf,itemsize) that returns the
+              encoded bytes of buf (a contiguous memoryview)
+    decode  - a function decode(buf,itemsize) that returns the
+              decoded bytes (any buffer, copied if it is read-only
+              so that the decoded arrays can be written to)
+    release - a function release(buf) that frees the resources held
+              by an encoded frame that is never decoded [None]
+  """
+  if("," in name or "/" in name):
+    raise Exception("Codec name cannot contain ',' or '/'")
+  _codecs[name] = (encode,decode)
+  if(release is not None):
+    _releases[name] = release
+
+def get_codecs():
+  """ Returns the names of the registered codecs """
+  return list(_codecs.keys())
+
+def get_codec(name):
+  """
+  Returns the encode and decode functions of a codec. Raises an
+  error naming the missing package if the codec is not available
+  on this host (e.g., a message encoded with zstd by a peer)
+  """
+  if(name in _codecs):
+    return _codecs[name]
+  for key,pkg in _OPTCODECS.items():
+    if(key in name):
+      raise Exception("Codec '%s' is not available on this host (please install %s)"%(name,pkg))
+  raise Exception("Unknown codec '%s'"%(name))
+
+def select_codec(buf):
+  """
+  Selects a codec for a frame (the 'auto' codec). Small frames
+  are not compressed, floating point arrays are byte shuffled
+  before compression and everything else uses lz4. Only codecs
+  that every host has are selected (not the optional zstd codecs,
+  which the peer may not be able to decode)
+
+  Parameters:
+    buf - a memoryview of the frame
+
+  Returns the name of the codec
+  """
+  if(buf.nbytes < _MINZBYTES):
+    return 'none'
+  elif(buf.format in ('e','f','d') and buf.itemsize > 1):
+    return 'shuffle-lz4'
+  return 'lz4'
+
+def shuffle(buf,itemsize):
+  """ Groups the bytes of buf by their position within each item """
+  if(itemsize == 1): return buf
+  return np.frombuffer(buf,dtype='uint8').reshape(-1,itemsize).T.tobytes()
+
+def unshuffle(buf,itemsize):
+  """ Inverse of shuffle """
+  if(itemsize == 1): return buf
+  return np.frombuffer(buf,dtype='uint8').reshape(itemsize,-1).T.copy().reshape(-1)
+
+def _lz4codec(level):
+  """ Creates the lz4 codec functions for a compression level """
+  enc = lambda buf,itemsize: lz4.frame.compress(buf,compression_level=level)
+  dec = lambda buf,itemsize: lz4.frame.decompress(buf,return_bytearray=True)
+  return enc,dec
+
+def _zstdcodec(level):
+  """ Creates the zstd codec functions for a compression level """
+  enc = lambda buf,itemsize: zstandard.ZstdCompressor(level=level).compress(buf)
+  dec = lambda buf,itemsize: zstandard.ZstdDecompressor().decompress(buf)
+  return enc,dec
+
+def _shufflecodec(enc,dec):
+  """ Adds a byte shuffle in front of a codec """
+  senc = lambda buf,itemsize: enc(shuffle(buf,itemsize),itemsize)
+  sdec = lambda buf,itemsize: unshuffle(dec(buf,itemsize),itemsize)
+  return senc,sdec
+
+def _shmcodec():
+  """
+  Creates the shm codec functions. Large frames are copied into a
+  shared memory segment and only its name is sent. The receiver
+  maps the segment and the decoded arrays are built directly over
+  it (no copy). The segment is removed once these arrays are
+  released. This codec is only for a server and workers on the same
+  host (client.localworkers). A message that is not decoded must be
+  released (release_frames) and cannot be forwarded (aggregator).
+  The sender gives up the segment when the message is encoded: a
+  message that is never received (e.g., its sender is stopped) leaves
+  its segments in /dev/shm
+  """
+  def enc(buf,itemsize):
+    if(buf.nbytes < _MINSHMBYTES):
+      return b"\x00" + bytes(buf)
+    shm = shared_memory.SharedMemory(create=True,size=buf.nbytes)
+    shm.buf[:buf.nbytes] = buf
+    name = shm.name
+    shm.close()
+    # The receiver owns (and unlinks) the segment
+    resource_tracker.unregister(shm._name,"shared_memory")
+    return b"\x01" + pickle.dumps((name,buf.nbytes))
+  def dec(buf,itemsize):
+    buf = memoryview(buf)
+    if(buf[0] == 0):
+      return buf[1:]
+    name,size = pickle.loads(buf[1:])
+    shm = shared_memory.SharedMemory(name=name)
+    # A mapping of its own outlives shm (and keeps it from being closed
+    # while the decoded arrays use it)
+    data = np.frombuffer(mmap.mmap(shm._fd,size),dtype='uint8')
+    shm.close()
+    weakref.finalize(data,unlink,shm)
+    return data
+  def rel(buf):
+    buf = memoryview(buf)
+    if(buf[0] == 0): return
+    name,size = pickle.loads(buf[1:])
+    try:
+      shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+      return
+    shm.close()
+    unlink(shm)
+  def unlink(shm):
+    # The segment may already be released (e.g., a decoded message)
+    try:
+      shm.unlink()
+    except FileNotFoundError:
+      resource_tracker.unregister(shm._name,"shared_memory")
+  return enc,dec,rel
+
+# Registered codecs (and the release functions of those holding resources)
+_codecs,_releases = {},{}
+register_codec('none',lambda buf,itemsize: buf,lambda buf,itemsize: buf)
+for level in [0,3,9,16]:
+  register_codec('lz4-%d'%(level),*_lz4codec(level))
+register_codec('lz4',*_codecs['lz4-0'])
+register_codec('shuffle-lz4',*_shufflecodec(*_lz4codec(0)))
+if(zstandard is not None):
+  for level in [1,3,9,19]:
+    register_codec('zstd-%d'%(level),*_zstdcodec(level))
+  register_codec('zstd',*_codecs['zstd-3'])
+  register_codec('shuffle-zstd',*_shufflecodec(*_zstdcodec(3)))
+if(shared_memory is not None):
+  register_codec('shm',*_shmcodec())
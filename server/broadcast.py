@@ -0,0 +1,179 @@
+"""
+Shared data sent once to each worker instead of with every chunk
+
+@author: Joseph Jennings
+@version: 2020.10.09
+"""
+import hashlib, pickle
+import weakref
+from comm.sendrecv import dumps_frames, _framebuf, _ENVTAG
+from comm.relay import relay
+
+class broadcaster:
+  """
+  Registers named objects (e.g., a velocity model or a wavelet)
+  that are needed by every chunk. The chunks only carry a reference
+  to each object (its content hash) and the workers fetch an object
+  the first time they see its hash (client.cache)
+
+  With fanout, the objects are broadcast through a tree of workers
+  with relays (comm.relay): the server sends each object to fanout
+  workers and each worker forwards it block by block to fanout others
+
+  Each job pins the references it is given when it starts (pin). An
+  object is dropped once no name refers to it and no job pins it
+  """
+
+  def __init__(self,zlevel=-1,oob=False,codec=None,fanout=None,address=None,host=None,
+               blocksize=4*1024**2):
+    """
+    broadcaster constructor
+
+    Parameters:
+      zlevel    - level of compression of the objects [-1]
+      oob       - send the objects with out-of-band buffers [False]
+      codec     - name of a codec or 'auto' (overrides zlevel and oob) [None]
+      fanout    - number of children of each node of the broadcast tree
+                  (1 for a chain) [None, each worker fetches from the server]
+      address   - the address to which the relay of the server binds
+                  (with fanout) [None, a random port]
+      host      - the host name of the server given to the workers [None]
+      blocksize - size of the blocks sent down the tree [4 MB]
+    """
+    self.zlevel = zlevel
+    self.oob    = oob
+    self.codec  = codec
+    # Hash of each name and encoded object of each hash
+    self.hashes  = {}
+    self.objects = {}
+    # Number of jobs that pin each object
+    self.holds   = {}
+    # Relays of the workers in the tree of each object
+    self.fanout = fanout
+    self.tree   = {}
+    self.relay  = None
+    if(fanout is not None):
+      self.relay = relay(address,host,blocksize)
+
+  def register(self,name,obj):
+    """
+    Registers an object. The object is encoded once and
+    is given to the workers in chunk[name]. Registering a
+    name again replaces the object for the next jobs (the
+    previous one is dropped once no job pins it)
+
+    Parameters:
+      name - the key of the object in the chunks
+      obj  - the object to share
+
+    Returns the content hash of the object
+    """
+    frames = dumps_frames({'obj': obj},self.oob,self.zlevel,codec=self.codec)
+    hsh = hashlib.blake2b(digest_size=16)
+    for frame in frames:
+      hsh.update(_framebuf(frame))
+    hsh = hsh.hexdigest()
+    if(hsh not in self.objects):
+      # The hash is sent back in the envelope so the worker can match the reply
+      self.objects[hsh] = [_ENVTAG, pickle.dumps({'_shared': hsh})] + frames
+      if(self.relay is not None):
+        self.relay.publish(hsh,frames)
+    old = self.hashes.get(name)
+    self.hashes[name] = hsh
+    if(old is not None and old != hsh):
+      self.drop(old)
+    return hsh
+
+  def unregister(self,name) -> None:
+    """ Removes a shared object """
+    self.drop(self.hashes.pop(name))
+
+  def drop(self,hsh) -> None:
+    """ Drops an object if no name refers to it and no job pins it """
+    if(hsh in self.hashes.values() or self.holds.get(hsh,0) > 0):
+      return
+    self.objects.pop(hsh,None)
+    self.tree.pop(hsh,None)
+    if(self.relay is not None):
+      self.relay.unpublish(hsh)
+
+  def refs(self):
+    """ Returns the references carried by the chunks ({name: hash}) """
+    return dict(self.hashes)
+
+  def pin(self):
+    """
+    Returns the current references (a sharedrefs). Their objects
+    are kept until the references are released, even if the
+    names are registered again (e.g., by the next job)
+    """
+    return sharedrefs(self,self.refs())
+
+  def hold(self,hashes) -> None:
+    """ Pins the objects of hashes """
+    for hsh in hashes:
+      self.holds[hsh] = self.holds.get(hsh,0) + 1
+
+  def unhold(self,hashes) -> None:
+    """ Unpins the objects of hashes (and drops those no longer used) """
+    for hsh in hashes:
+      self.holds[hsh] -= 1
+      if(self.holds[hsh] == 0):
+        del self.holds[hsh]
+        self.drop(hsh)
+
+  def frames(self,hsh):
+    """ Returns the message frames of the object with hash hsh """
+    if(hsh not in self.objects):
+      raise Exception("Unknown shared object %s"%(hsh))
+    return self.objects[hsh]
+
+  def reply(self,ctl):
+    """
+    Returns the reply to a fetch request: the object or, for a worker
+    with a relay ('_relay'), the address of its parent in the tree
+    """
+    hsh = ctl['_shared']
+    if(hsh not in self.objects):
+      # A late chunk of a job that is over (its result is discarded)
+      return dumps_frames({'_shared': hsh, '_gone': True})
+    if(self.relay is None or '_relay' not in ctl):
+      return self.frames(hsh)
+    # The workers are placed in the tree in the order of their requests
+    nodes = self.tree.setdefault(hsh,[])
+    iparent = len(nodes)//self.fanout
+    parent = self.relay.address if(iparent == 0) else nodes[iparent-1]
+    nodes.append(ctl['_relay'])
+    return dumps_frames({'_shared': hsh, '_parent': parent})
+
+class sharedrefs:
+  """
+  The references of the shared objects of a job. The objects
+  are pinned on the broadcaster until release is called (or
+  the references are garbage collected)
+  """
+
+  def __init__(self,shared,hashes):
+    """
+    sharedrefs constructor
+
+    Parameters:
+      shared - the broadcaster of the objects
+      hashes - the references ({name: hash})
+    """
+    self.shared = shared
+    self.hashes = hashes
+    shared.hold(hashes.values())
+    self.release = weakref.finalize(self,shared.unhold,list(hashes.values()))
+
+  def refs(self):
+    """ Returns the references carried by the chunks ({name: hash}) """
+    return dict(self.hashes)
+
+  def pin(self):
+    """ Returns another pin of the same references """
+    return sharedrefs(self.shared,self.hashes)
+
+  def reply(self,ctl):
+    """ Returns the reply to a fetch request (see broadcaster.reply) """
+    return self.shared.reply(ctl)
@@ -0,0 +1,187 @@
+"""
+Checkpoints of the outputs of a distributed job so
+that an interrupted job can be resumed
+
+@author: Joseph Jennings
+@version: 2020.10.05
+"""
+import os, glob, time
+import pickle
+import numpy as np
+from server.store import resultstore, lazylist
+
+# A checkpoint is saved at most once per this many times the last save took
+_SAVERATIO = 10
+
+class checkpoint:
+  """
+  Periodically saves the indices of the completed chunks
+  and the outputs of a job (dstr_collect or dstr_sum) to
+  a directory.
+
+  The checkpoint is a journal: each save appends only what
+  changed since the previous one (the new chunks and their
+  results) so that a save does not get slower as the job
+  grows. A save interrupted while being written is ignored
+  when the journal is read back. Accumulated outputs (sums) are
+  saved whole, so the checkpoints are spaced by at least ten
+  times the time the last save took to bound their overhead
+  """
+
+  def __init__(self,path,freq=60.0,resume=False):
+    """
+    checkpoint constructor
+
+    Parameters:
+      path   - the directory in which the checkpoint is saved
+      freq   - minimum number of seconds between two checkpoints [60.0]
+      resume - load the checkpoint saved in path (if any) [False]
+    """
+    self.path  = path
+    self.freq  = freq
+    self.fname = os.path.join(path,'checkpoint.log')
+    os.makedirs(path,exist_ok=True)
+    self.last  = time.time()
+    # Time taken by the last save
+    self.tsave = 0.0
+    # Completed chunks and restored outputs
+    self.cids  = set()
+    self.state = {}
+    # Items (or messages) of each output already saved
+    self.nsaved = {}
+    # Current snapshot of each accumulated output
+    self.snaps   = {}
+    self.version = 0
+    if(resume and os.path.exists(self.fname)):
+      self.load()
+    else:
+      # Start a new journal
+      for fname in [self.fname] + glob.glob(os.path.join(path,'snap-*.npy')):
+        if(os.path.exists(fname)): os.remove(fname)
+
+  def load(self) -> None:
+    """ Reads the journal and rebuilds the completed chunks and the outputs """
+    end = 0
+    with open(self.fname,'rb') as f:
+      while True:
+        try:
+          cids,deltas = pickle.load(f)
+        except (EOFError,pickle.UnpicklingError,ValueError):
+          # The last save was interrupted
+          break
+        self.cids.update(cids)
+        for key,delta in deltas.items():
+          self.apply(key,delta)
+        end = f.tell()
+    # Drop an incomplete record so that new saves follow the last complete one
+    with open(self.fname,'r+b') as f:
+      f.truncate(end)
+
+  def apply(self,key,delta) -> None:
+    """ Applies a saved change to an output """
+    kind = delta[0]
+    if(kind == 'extend'):
+      self.state.setdefault(key,[]).extend(delta[1])
+      self.nsaved[key] = len(self.state[key])
+    elif(kind == 'store'):
+      store = self.state.setdefault(key,resultstore())
+      for ctl,frames in delta[1]:
+        store.add(ctl,frames)
+      self.nsaved[key] = len(store.msgs)
+    elif(kind == 'lazy'):
+      self.state[key] = delta
+    elif(kind == 'rows'):
+      idx,rows,shape,dtype = delta[1:]
+      if(key not in self.state):
+        self.state[key] = np.zeros(shape,dtype=dtype)
+      self.state[key][idx] = rows
+    elif(kind == 'memmap'):
+      self.state[key] = delta
+    elif(kind == 'snapshot'):
+      self.state[key] = delta
+      self.snaps[key] = delta[1]
+      self.version = max(self.version,delta[2] + 1)
+
+  def due(self):
+    """ Checks if a checkpoint should be saved """
+    return time.time() - self.last >= max(self.freq,_SAVERATIO*self.tsave)
+
+  def has(self,key):
+    """ Checks if an output was restored from the checkpoint """
+    return key in self.state
+
+  def restore(self,key):
+    """
+    Returns an output saved in the checkpoint. Memory-mapped
+    arrays are opened again from their files (an accumulated
+    one is first written back from its snapshot)
+    """
+    val = self.state[key]
+    if(isinstance(val,tuple) and val[0] == 'memmap'):
+      return np.memmap(val[1],dtype=val[2],mode='r+',shape=val[3])
+    if(isinstance(val,tuple) and val[0] == 'snapshot'):
+      snap = np.load(val[1],mmap_mode='r')
+      if(val[3] is None):
+        return np.array(snap)
+      # Results added to the file after the snapshot are discarded
+      out = np.memmap(val[3],dtype=snap.dtype,mode='w+',shape=snap.shape)
+      out[:] = snap
+      return out
+    if(isinstance(val,tuple) and val[0] == 'lazy'):
+      return lazylist(self.state['_store'],key)
+    return val
+
+  def save(self,cids,outputs,accumulated=False) -> None:
+    """
+    Saves a checkpoint
+
+    Parameters:
+      cids        - the indices of the chunks completed since the last save
+      outputs     - a dictionary of the outputs that contain the results
+                    of the completed chunks (and possibly of others). Lists
+                    grow in the order of arrival and arrays are indexed by
+                    chunk. Memory-mapped arrays are flushed and saved by
+                    reference
+      accumulated - the outputs are sums over the chunks. They are saved
+                    whole in a snapshot file (including memory maps, which
+                    may already hold results of chunks not in cids) [False]
+    """
+    beg = time.time()
+    deltas,old = {},{}
+    for key,val in outputs.items():
+      if(accumulated):
+        snap = os.path.join(self.path,'snap-%s.%d.npy'%(key,self.version))
+        np.save(snap,val)
+        fname = val.filename if(isinstance(val,np.memmap)) else None
+        deltas[key] = ('snapshot',snap,self.version,fname)
+        old[key] = self.snaps.get(key)
+        self.snaps[key] = snap
+      elif(isinstance(val,np.memmap)):
+        val.flush()
+        deltas[key] = ('memmap',val.filename,val.dtype.str,val.shape)
+      elif(isinstance(val,np.ndarray)):
+        idx = [cid for cid in cids if(cid is not None)]
+        deltas[key] = ('rows',idx,val[idx],val.shape,val.dtype.str)
+      elif(isinstance(val,lazylist)):
+        # The messages of the store are saved once for all its keys
+        nsaved = self.nsaved.get('_store',0)
+        if('_store' not in deltas):
+          deltas['_store'] = ('store',val.store.messages(nsaved))
+          self.nsaved['_store'] = len(val.store.msgs)
+        deltas[key] = ('lazy',)
+      else:
+        nsaved = self.nsaved.get(key,0)
+        deltas[key] = ('extend',list(val[nsaved:]))
+        self.nsaved[key] = len(val)
+    self.version += 1
+    # Append and sync: an interrupted write is ignored when loading
+    with open(self.fname,'ab') as f:
+      pickle.dump((list(cids),deltas),f,protocol=-1)
+      f.flush()
+      os.fsync(f.fileno())
+    self.cids.update(cids)
+    # The previous snapshots are no longer needed
+    for snap in old.values():
+      if(snap is not None and os.path.exists(snap)): os.remove(snap)
+    self.last  = time.time()
+    self.tsave = self.last - beg
@@ -0,0 +1,451 @@
+"""
+Keeps track of the chunks handed out to the workers
+
+@author: Joseph Jennings
+@version: 2020.09.30
+"""
+from comm.sendrecv import dumps_frames, release_frames
+from server.tuner import codectuner
+from concurrent.futures import ThreadPoolExecutor
+import os, time, random
+import warnings
+import threading, queue
+import types, itertools
+from collections import deque
+
+# Target size of a batch of chunks with batch='auto'
+_BATCHBYTES = 1 << 20
+# Ids of the jobs (one per dispatcher)
+_jobids = itertools.count(random.randrange(1 << 30))
+
+class dispatcher:
+  """
+  Pulls chunks from a generator and tags each (dictionary) chunk
+  with its index in the generator (the '_cid' key) and the id of
+  the job (the '_job' key) so that a returned result can be matched
+  to its chunk. Results of other jobs (e.g., late copies from a job
+  that was stopped early) are discarded by the engines
+  """
+
+  def __init__(self,gen,window=None,zlevel=-1,oob=False,codec=None,prefetch=0,batch=None,
+               speculate=0,lease=None,skip=None,shared=None):
+    """
+    dispatcher constructor
+
+    Parameters:
+      gen      - an input generator that gives a chunk
+      window   - maximum number of chunks that may be handed out
+                 ahead of the first chunk not yet consumed (base) [None]
+      zlevel   - level of compression of the chunks [-1]
+      oob      - send chunks with out-of-band buffers [False]
+      codec    - name of a codec or 'auto' (overrides zlevel and oob).
+                 With 'adapt' (or a codectuner), the codec is tuned online
+                 and sent to the workers with each chunk ('_codec') [None]
+      prefetch - number of chunks pulled from the generator and encoded
+                 ahead of demand by a background thread (and a pool of up
+                 to prefetch threads for the encoding) [0]
+      batch    - number of consecutive chunks sent together in a single
+                 message ({'_batch': [chunks]}) or 'auto' to batch chunks
+                 up to about 1 MB per message [None]
+      speculate - once the generator is exhausted, send up to speculate
+                  extra copies of the slowest outstanding chunks to idle
+                  workers. The first result is kept and the others are
+                  discarded (not for partial sums on the workers) [0]
+      lease     - number of seconds a worker may keep a chunk. The chunks
+                  of expired leases (e.g., lost workers) are handed out
+                  again and the first result is kept. A chunk kept in a
+                  partial sum on a worker stays leased until the sum arrives
+                  (renewed each time the worker is heard from) [None]
+      skip      - indices of chunks in the generator that are already
+                  done (e.g., restored from a checkpoint). They are
+                  pulled from the generator but not handed out [None]
+      shared    - a broadcaster of objects shared by all chunks. The chunks
+                  carry references to the objects ('_refs') that the workers
+                  fetch once (server.broadcast). The references are taken
+                  (and pinned until close) when the dispatcher is created,
+                  or are those of a sharedrefs given instead [None]
+    """
+    if(not isinstance(gen,types.GeneratorType)):
+      raise Exception("Please provide a valid generator as input")
+    self.gen    = gen
+    self.window = window
+    self.zlevel = zlevel
+    self.oob    = oob
+    self.codec  = codec
+    self.batch  = batch
+    self.shared = shared.pin() if(shared is not None) else None
+    self.tuner  = None
+    if(isinstance(codec,codectuner)):
+      self.tuner = codec
+    elif(codec == 'adapt'):
+      self.tuner = codectuner()
+    # Index of the next chunk pulled from the generator
+    self.ncid   = 0
+    self.job    = next(_jobids)
+    self.skip   = set() if(skip is None) else set(skip)
+    # Number of chunks handed out
+    self.nout   = 0
+    # First chunk not yet consumed (set by the consumer)
+    self.base   = 0
+    # Generator is exhausted
+    self.done   = False
+    # Outstanding chunks (for speculative copies and leases)
+    self.speculate = speculate
+    self.lease     = lease
+    self.tracked   = speculate > 0 or lease is not None
+    self.pending   = {}
+    self.recvd     = set()
+    # Chunks of expired leases
+    self.requeue   = deque()
+    # Last time each worker was heard from (for the chunks in partial sums)
+    self.lastseen  = {}
+    self.nexpired  = 0
+    # Warned that the partial sums of a REP socket are not leased
+    self.warned    = False
+    self.lastcheck = time.time()
+    # Time per chunk (overall and per worker)
+    self.rate      = None
+    self.rates     = {}
+    self.nspec,self.ndup = 0,0
+    # Background producer
+    self.ready   = None
+    self.encoded = {}
+    if(prefetch > 0):
+      self.ready = queue.Queue(maxsize=prefetch)
+      self.pool  = ThreadPoolExecutor(min(prefetch,os.cpu_count() or 1))
+      self.stop  = False
+      self.producer = threading.Thread(target=self.produce,daemon=True)
+      self.producer.start()
+
+  def tag(self,chunk):
+    """ Tags a chunk with its index (codec and shared references) """
+    if(isinstance(chunk,dict)):
+      chunk = dict(chunk,_cid=self.ncid,_job=self.job)
+      if(self.shared is not None):
+        chunk['_refs'] = self.shared.refs()
+      if(self.tuner is not None):
+        chunk['_codec'] = self.tuner.choose()
+    self.ncid += 1
+    return chunk
+
+  def draw(self):
+    """ Pulls and tags the next chunk that is not skipped """
+    while True:
+      chunk = next(self.gen)
+      if(self.ncid not in self.skip):
+        return self.tag(chunk)
+      self.ncid += 1
+
+  def pull(self):
+    """
+    Pulls the next message from the generator: a tagged chunk or
+    a batch of tagged chunks. Raises StopIteration when exhausted
+    """
+    if(self.batch is None):
+      return self.draw()
+    chunks,nbytes = [],0
+    while(self.batch == 'auto' or len(chunks) < self.batch):
+      # Do not batch past the window
+      if(self.window is not None and self.ncid >= self.base + self.window and len(chunks) > 0):
+        break
+      try:
+        chunk = self.draw()
+      except StopIteration:
+        if(len(chunks) == 0): raise
+        break
+      chunks.append(chunk)
+      nbytes += chunk_nbytes(chunk)
+      if(self.batch == 'auto' and nbytes >= _BATCHBYTES):
+        break
+    if(len(chunks) == 1):
+      return chunks[0]
+    batch = {'_batch': chunks, '_job': self.job}
+    if('_codec' in chunks[0]):
+      batch['_codec'] = chunks[0]['_codec']
+    return batch
+
+  def produce(self) -> None:
+    """ Pulls and encodes the chunks ahead of demand (background thread) """
+    try:
+      while(not self.stop):
+        try:
+          chunk = self.pull()
+        except StopIteration:
+          break
+        self.ready.put((chunk,self.pool.submit(self.encode_chunk,chunk)))
+      self.ready.put(None)
+    except Exception as e:
+      # Raised when the chunk is requested
+      self.ready.put(e)
+
+  def next(self,wid=None):
+    """
+    Returns the next chunk to hand out (to worker wid) or an
+    empty chunk if there is no work at the moment
+    """
+    while(len(self.requeue) > 0):
+      # Hand out again the chunk of an expired lease
+      entry = self.pending.get(self.requeue.popleft())
+      if(entry is not None):
+        entry[1],entry[2],entry[4],entry[5] = time.time(),wid,1,False
+        return entry[0]
+    if(self.done and self.speculate > 0):
+      return self.straggler(wid)
+    if(self.done or self.held()):
+      return {}
+    if(self.ready is not None):
+      item = self.ready.get()
+      if(isinstance(item,Exception)):
+        raise item
+      if(item is None):
+        self.done = True
+        return {}
+      chunk,future = item
+      cids = chunk_cids(chunk)
+      if(len(cids) > 0):
+        self.encoded[cids[0]] = future
+    else:
+      try:
+        chunk = self.pull()
+      except StopIteration:
+        self.done = True
+        return {}
+    self.nout += max(len(chunk_cids(chunk)),1)
+    if(self.tracked):
+      self.track(chunk,wid)
+
+    return chunk
+
+  def track(self,chunk,wid=None) -> None:
+    """ Records the dispatch of a chunk (or a batch) to worker wid """
+    if(not isinstance(chunk,dict)): return
+    chunks = chunk['_batch'] if('_batch' in chunk) else [chunk]
+    now = time.time()
+    for ichunk in chunks:
+      if('_cid' in ichunk):
+        # Chunk, dispatch time, worker, copies, chunks in the message
+        # and whether the result is kept in a partial sum on the worker
+        self.pending[ichunk['_cid']] = [ichunk,now,wid,0,len(chunks),False]
+
+  def straggler(self,wid=None):
+    """
+    Returns a copy of the outstanding chunk that worker wid would
+    finish the earliest compared to its current worker (an empty
+    chunk if none would finish earlier)
+    """
+    if(self.rate is None):
+      return {}
+    now  = time.time()
+    mine = self.rates.get(wid,self.rate)
+    best,gain = None,0.0
+    for cid,(chunk,beg,owid,ncopy,nb,kept) in self.pending.items():
+      if(kept or ncopy >= self.speculate or (wid is not None and owid == wid)):
+        continue
+      # Expected finish (a late chunk needs at least as long again)
+      eta = max(beg + nb*self.rates.get(owid,self.rate),2*now - beg)
+      if(eta - now - mine > gain):
+        best,gain = cid,eta - now - mine
+    if(best is None):
+      return {}
+    self.pending[best][3] += 1
+    self.nspec += 1
+    return self.pending[best][0]
+
+  def timeout(self):
+    """
+    Returns the time to wait for a message (ms) before checking the
+    leases and, at the tail, the stragglers for speculative copies
+    """
+    waits = []
+    if(self.lease is not None):
+      waits.append(250*self.lease)
+    if(self.speculate > 0 and self.done):
+      # A few times per chunk (the held credits of idle workers are served again)
+      waits.append(250*self.rate if(self.rate is not None) else 100)
+    if(len(waits) == 0): return None
+    return max(int(min(waits)),1)
+
+  def expire(self) -> None:
+    """ Queues the outstanding chunks whose lease has expired """
+    if(self.lease is None): return
+    now = time.time()
+    # Check a few times per lease
+    if(now - self.lastcheck < self.lease/4): return
+    self.lastcheck = now
+    queued = set(self.requeue)
+    for cid,entry in self.pending.items():
+      # A chunk in a partial sum is leased as long as its worker is heard from
+      beg = self.lastseen.get(entry[2],entry[1]) if(entry[5]) else entry[1]
+      if(now - beg > self.lease and cid not in queued):
+        self.requeue.append(cid)
+        self.nexpired += 1
+
+  def finished(self,cids,wid=None) -> None:
+    """ Records that worker wid finished the chunks cids """
+    if(not self.tracked): return
+    now = time.time()
+    for cid in cids:
+      entry = self.pending.pop(cid,None)
+      if(entry is None or entry[2] != wid or entry[5]): continue
+      self.observe(entry,wid,now)
+
+  def reported(self,cids,wid=None) -> None:
+    """
+    Records that worker wid finished the chunks cids and keeps
+    their results in a partial sum. With leases, the chunks stay
+    outstanding until the partial sum arrives (ROUTER socket only.
+    The workers of a REP socket are not known and the chunks are
+    no longer leased)
+    """
+    if(self.lease is None):
+      self.finished(cids,wid)
+      return
+    if(wid is None):
+      if(not self.warned):
+        warnings.warn("The chunks kept in partial sums on the workers are only leased "
+                      "with a ROUTER socket. They are not handed out again if a worker is lost")
+        self.warned = True
+      self.finished(cids,wid)
+      return
+    now = time.time()
+    for cid in cids:
+      entry = self.pending.get(cid)
+      if(entry is None or entry[2] != wid or entry[5]): continue
+      self.observe(entry,wid,now)
+      entry[5] = True
+
+  def observe(self,entry,wid,now) -> None:
+    """ Updates the time per chunk (overall and of worker wid) """
+    dur = (now - entry[1])/entry[4]
+    self.rate = dur if(self.rate is None) else 0.7*self.rate + 0.3*dur
+    self.rates[wid] = dur if(wid not in self.rates) else 0.7*self.rates[wid] + 0.3*dur
+
+  def heard(self,wid) -> None:
+    """ Records that worker wid is alive (renews the leases of its partial sums) """
+    if(self.lease is not None):
+      self.lastseen[wid] = time.time()
+
+  def encode_chunk(self,chunk):
+    """ Encodes a chunk. Returns the frames and the encoding information """
+    codec = self.codec if(self.tuner is None) else chunk.get('_codec','auto')
+    info = {'codec': codec}
+    beg = time.time()
+    frames = dumps_frames(chunk,self.oob,self.zlevel,codec=codec,info=info)
+    info['tenc'] = time.time() - beg
+    return frames,info
+
+  def encode(self,chunk):
+    """ Returns the message frames of a chunk (encoded ahead if prefetched) """
+    cids = chunk_cids(chunk)
+    cid = cids[0] if(len(cids) > 0) else None
+    if(cid in self.encoded):
+      frames,info = self.encoded.pop(cid).result()
+    else:
+      frames,info = self.encode_chunk(chunk)
+    if(self.tuner is not None and cid is not None):
+      self.tuner.sent(cid,info['codec'],info['tenc'],info['raw'],info['nbytes'])
+    return frames
+
+  def received(self,ctl,wid=None):
+    """
+    Records the arrival of a result (its control dictionary)
+    from worker wid. Returns the ids of the chunks received for
+    the first time (the others are speculative duplicates)
+    """
+    cids = result_cids(ctl)
+    if(self.tuner is not None and not ctl.get('_partial',False)):
+      self.tuner.received(cids[0],ctl.get('_tcmp',0.0))
+    if(not self.tracked):
+      return cids
+    if(ctl.get('_partial',False) and any([cid in self.recvd for cid in cids])):
+      # A partial sum cannot be split: it is discarded and the chunks
+      # that were only in this sum are handed out again
+      for cid in cids:
+        entry = self.pending.get(cid)
+        if(cid in self.recvd or entry is None or entry[2] != wid): continue
+        entry[5] = False
+        if(cid not in self.requeue):
+          self.requeue.append(cid)
+      self.ndup += len(cids)
+      return []
+    self.finished(cids,wid)
+    new = [cid for cid in cids if(cid not in self.recvd)]
+    self.recvd.update(new)
+    self.ndup += len(cids) - len(new)
+    return new
+
+  def stale(self,ctl):
+    """ Checks if a message (its control dictionary) is from another job """
+    return ctl.get('_job',self.job) != self.job
+
+  def fetch(self,ctl):
+    """ Returns the reply to a request of a shared object """
+    if(self.shared is None):
+      raise Exception("No objects are shared with the workers")
+    return self.shared.reply(ctl)
+
+  def held(self):
+    """ Checks if handing out more chunks would exceed the window """
+    if(len(self.requeue) > 0):
+      return False
+    return self.window is not None and self.nout >= self.base + self.window
+
+  def close(self) -> None:
+    """
+    Unpins the shared objects, stops the background producer
+    and releases the chunks that were encoded ahead but not sent
+    """
+    if(self.shared is not None):
+      self.shared.release()
+    if(self.ready is None): return
+    self.stop = True
+    # Unblock the producer until it exits (it may put a chunk again
+    # before it sees stop)
+    unsent = list(self.encoded.values())
+    while(self.producer.is_alive() or not self.ready.empty()):
+      try:
+        item = self.ready.get(timeout=0.05)
+      except queue.Empty:
+        continue
+      if(isinstance(item,tuple)):
+        unsent.append(item[1])
+    self.producer.join()
+    self.encoded = {}
+    for future in unsent:
+      if(future.exception() is None):
+        release_frames(future.result()[0])
+    self.pool.shutdown(wait=False)
+
+  def stats(self):
+    """ Returns statistics of the chunks handed out """
+    stats = {'nchunks': self.nout}
+    if(self.tracked):
+      stats.update({'nspec': self.nspec, 'ndup': self.ndup, 'nexpired': self.nexpired})
+    if(self.tuner is not None):
+      stats.update(self.tuner.stats())
+    return stats
+
+def result_cids(rdict):
+  """
+  Returns the list of chunk ids covered by a result. A partial
+  result reduced on a worker covers several chunks ('_cids')
+  """
+  if('_cids' in rdict):
+    return rdict['_cids']
+  return [rdict.get('_cid')]
+
+def chunk_cids(chunk):
+  """ Returns the list of chunk ids in a message (a chunk or a batch) """
+  if(not isinstance(chunk,dict)):
+    return []
+  if('_batch' in chunk):
+    return [ichunk['_cid'] for ichunk in chunk['_batch']]
+  if('_cid' in chunk):
+    return [chunk['_cid']]
+  return []
+
+def chunk_nbytes(chunk):
+  """ Estimates the size of a chunk from the arrays it contains """
+  if(not isinstance(chunk,dict)):
+    return getattr(chunk,'nbytes',0)
+  return sum([getattr(val,'nbytes',0) for val in chunk.values()]) + 64*len(chunk)
@@ -1,8 +1,23 @@
-from comm.sendrecv import recv_zipped_pickle, send_next_chunk
+from comm.sendrecv import loads_ctl, release_frames
+from server.dispatch import dispatcher, result_cids
+from server.checkpoint import checkpoint
+from server.store import resultstore, lazylist, decode_message
+from server.router import rtr_messages
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import queue
+import zmq
 import numpy as np
-from genutils.ptyprint import printprogress
+try:
+  from genutils.ptyprint import printprogress
+except ImportError:
+  def printprogress(tag,i,n):
+    """ Prints the progress of a job (without genutils) """
+    print("%s %d/%d"%(tag,i,n),end="\n" if(i >= n) else "\r",flush=True)
 
-def dstr_collect(keys,n,gen,socket,zlevel=-1,verb=False):
+def dstr_collect(keys,n,gen,socket,zlevel=-1,verb=False,oob=False,credits=None,nthreads=0,codec=None,
+                 stats=None,prefetch=0,batch=None,speculate=0,lease=None,outputs=None,nflush=None,
+                 ckpt=None,ckptfreq=60.0,resume=False,lazy=False,cache=0,shared=None):
   """
   Distributes data to workers
   and collects the results based on the keys passed
@@ -11,42 +26,130 @@ def dstr_collect(keys,n,gen,socket,zlevel=-1,verb=False):
     keys     - list of keys to expect to receive from client
     n        - length of input generator
     gen      - an input generator that gives a chunk
-    socket   - a ZMQ socket
+    socket   - a ZMQ socket (REP or ROUTER)
     zlevel   - level of compression [0]
+    verb     - verbosity flag [False]
+    oob      - send and receive arrays as out-of-band frames
+               without compression or copies [False]
+    credits  - maximum number of chunks in flight per worker
+               (ROUTER socket only) [None, as requested by worker]
+    nthreads - decode the results in a pool of nthreads threads
+               while the socket keeps serving workers [0]
+    codec    - name of a codec (comm.sendrecv.get_codecs), 'auto' to
+               select one for each frame or 'adapt' to tune it online
+               (overrides zlevel and oob) [None]
+    stats    - a dictionary to be filled with statistics of the run
+               (e.g., the codec chosen with 'adapt') [None]
+    prefetch - number of chunks pulled from the generator and encoded
+               ahead of demand in background threads so that workers
+               are answered immediately [0]
+    batch    - number of consecutive chunks sent to a worker in a single
+               message or 'auto' to batch small chunks up to about 1 MB.
+               The results are returned in a single message and unpacked
+               on the server [None]
+    speculate - once all chunks are handed out, send up to speculate
+                extra copies of the slowest outstanding chunks to idle
+                workers and keep the first result to arrive. Not to be
+                used with partial sums on the workers [0]
+    lease     - number of seconds a worker may keep a chunk before it
+                is handed out to another worker (e.g., if the worker
+                was lost). The first result to arrive is kept [None]
+    outputs   - a dictionary of the shape and type of the output array
+                of keys, e.g. {'result': ((n,nz,nx),'float32')}. The result
+                of each chunk is written directly in the output array at the
+                index of the chunk in the input generator. With a file name,
+                e.g. ((n,nz,nx),'float32','result.dat'), the output array is
+                a memory map of the file (for outputs larger than memory) [None]
+    nflush    - flush the memory-mapped outputs to disk every nflush
+                results [None, only at the end]
+    ckpt      - a directory in which the completed chunks and the outputs
+                are periodically saved (server.checkpoint) [None]
+    ckptfreq  - minimum number of seconds between two checkpoints [60.0]
+    resume    - resume from the checkpoint in ckpt. The chunks already
+                completed are skipped in the generator [False]
+    lazy      - keep the results as received (compressed) and decode
+                each one when it is accessed (server.store) [False]
+    cache     - number of decoded results kept in a least-recently-used
+                cache with lazy [0]
+    shared    - a broadcaster of objects needed by every chunk. The objects
+                are sent once to each worker and given in chunk[name]
+                (server.broadcast) [None]
 
   Returns a dictionary with keys of keys and values
-  returned by the client
+  returned by the client (lists in the order of arrival
+  or the output arrays given by outputs). With lazy, the
+  lists are lazylists that decode the results on access
   """
+  # Checkpoint
+  ck = checkpoint(ckpt,ckptfreq,resume) if(ckpt is not None) else None
+  done = set() if(ck is None) else ck.cids
+  # Chunks completed since the last checkpoint
+  cids = []
   # Create the outputs
   odict = {}
-  for ikey in keys: odict[ikey] = []
+  if(outputs is None): outputs = {}
+  if(lazy and len(outputs) > 0):
+    raise Exception("Lazy results cannot be written to outputs")
+  store = resultstore(cache) if(lazy) else None
+  for ikey in keys:
+    if(ck is not None and ck.has(ikey)):
+      odict[ikey] = ck.restore(ikey)
+      if(lazy):
+        store = odict[ikey].store
+        store.ncache = cache
+    elif(ikey in outputs):
+      odict[ikey] = alloc_output(*outputs[ikey])
+    elif(lazy):
+      odict[ikey] = lazylist(store,ikey)
+    else:
+      odict[ikey] = []
   # Control key
   ckey = keys[0]
+  nres = len(done)
+
+  def place(rdict):
+    # Write the results in the output arrays (in the decoding threads)
+    for okey in outputs:
+      odict[okey][rdict['_cid']] = rdict[okey]
+    return rdict
+
   # Verbosity
-  old = -1
-  # Send and collect work
-  while(len(odict[ckey]) < n):
-    if(verb):
-      if(old < len(odict[ckey])):
-        printprogress(ckey+":",len(odict[ckey]),n)
-        old = len(odict[ckey])
-    # Talk to client
-    rdict = recv_zipped_pickle(socket)
-    if(rdict['msg'] == "available"):
-      # Send work
-      send_next_chunk(socket,gen,zlevel)
-    elif(rdict['msg'] == "result"):
-      # Save the results
-      for ikey in keys:
-        odict[ikey].append(rdict[ikey])
-      # Send a "thank you" back
-      socket.send(b"")
+  if(verb): printprogress(ckey+":",nres,n)
+  # Send and collect work (skipping the completed chunks)
+  disp = dispatcher(gen,None,zlevel,oob,codec,prefetch,batch,speculate,lease,done,shared)
+  try:
+    for rdict in dstr_results(n-nres,disp,socket,credits=credits,nthreads=nthreads,
+                              func=place if(outputs) else None,stats=stats,decode=not lazy):
+      if(lazy):
+        # Keep the message as received
+        ctl,frames = rdict
+        cids += ctl.get('_keep',result_cids(ctl))
+        nres += store.add(ctl,frames)
+      else:
+        # Save the results
+        for ikey in keys:
+          if(ikey not in outputs):
+            odict[ikey].append(rdict[ikey])
+        cids.append(rdict.get('_cid'))
+        nres += 1
+      if(nflush is not None and nres%nflush == 0):
+        flush_outputs(odict)
+      if(ck is not None and ck.due()):
+        ck.save(cids,odict)
+        cids = []
+      if(verb and nres < n): printprogress(ckey+":",nres,n)
+  finally:
+    # Also saved if interrupted
+    if(ck is not None): ck.save(cids,odict)
 
-  if(verb): printprogress(ckey+":",len(odict[ckey]),n)
+  if(verb): printprogress(ckey+":",nres,n)
+  flush_outputs(odict)
 
   return odict
 
-def dstr_sum(ckey,rkey,n,gen,socket,shape,ikey='idx',zlevel=-1):
+def dstr_sum(ckey,rkey,n,gen,socket,shape,ikey='idx',zlevel=-1,oob=False,credits=None,nthreads=0,
+             codec=None,stats=None,prefetch=0,batch=None,speculate=0,lease=None,outfile=None,
+             nflush=None,ckpt=None,ckptfreq=60.0,resume=False,shared=None):
   """
   Distributes data to workers
   and sums over the collected results
@@ -56,35 +159,451 @@ def dstr_sum(ckey,rkey,n,gen,socket,shape,ikey='idx',zlevel=-1):
     rkey     - a result key for summing the results
     n        - length of input generator
     gen      - an input generator that gives a junk
-    socket   - a ZMQ socket
+    socket   - a ZMQ socket (REP or ROUTER)
     shape    - the shape of the output array
     ikey     - key for sending the index for chunked transfer ['idx']
     zlevel   - level of compression [0]
+    oob      - send and receive arrays as out-of-band frames
+               without compression or copies [False]
+    credits  - maximum number of chunks in flight per worker
+               (ROUTER socket only) [None, as requested by worker]
+    nthreads - decode and sum the results in a pool of nthreads
+               threads while the socket keeps serving workers. Each
+               thread may use its own output array (merged at the end) [0]
+    codec    - name of a codec (comm.sendrecv.get_codecs), 'auto' to
+               select one for each frame or 'adapt' to tune it online
+               (overrides zlevel and oob) [None]
+    stats    - a dictionary to be filled with statistics of the run
+               (e.g., the codec chosen with 'adapt') [None]
+    prefetch - number of chunks pulled from the generator and encoded
+               ahead of demand in background threads so that workers
+               are answered immediately [0]
+    batch    - number of consecutive chunks sent to a worker in a single
+               message or 'auto' to batch small chunks up to about 1 MB.
+               The results are returned in a single message and unpacked
+               on the server [None]
+    speculate - once all chunks are handed out, send up to speculate
+                extra copies of the slowest outstanding chunks to idle
+                workers and keep the first result to arrive. Not to be
+                used with partial sums on the workers [0]
+    lease     - number of seconds a worker may keep a chunk before it
+                is handed out to another worker (e.g., if the worker
+                was lost). The first result to arrive is kept. With partial
+                sums on the workers (ROUTER socket only), the chunks of a
+                partial sum are handed out again if the worker is not heard
+                from for lease seconds before the sum arrives. A late sum
+                that overlaps results already received is discarded. With a
+                REP socket, the chunks are no longer leased once they are
+                kept in a partial sum (with a warning) [None]
+    shared    - a broadcaster of objects needed by every chunk. The objects
+                are sent once to each worker and given in chunk[name]
+                (server.broadcast) [None]
+    outfile   - accumulate the sum in a memory map of the file outfile
+                (for outputs larger than memory). The results are then
+                summed one at a time in a single output array [None]
+    nflush    - flush the memory-mapped output to disk every nflush
+                results [None, only at the end]
+    ckpt      - a directory in which the completed chunks and the sum
+                are periodically saved (server.checkpoint). The sum is saved
+                whole in a snapshot file (also with outfile, which is written back
+                from the snapshot on resume), so a checkpoint writes the size
+                of the output. Checkpoints are spaced by at least ten times
+                the time the last one took [None]
+    ckptfreq  - minimum number of seconds between two checkpoints [60.0]
+    resume    - resume from the checkpoint in ckpt. The chunks already
+                completed are skipped in the generator [False]
+
+  Workers can also keep a local sum over several chunks
+  and return it as a partial result (client.worker.partialsum)
 
   Returns:
     Sums over the work returned by workers to give an
     output array of size shape
   """
+  # Checkpoint
+  ck = checkpoint(ckpt,ckptfreq,resume) if(ckpt is not None) else None
   # Create the outputs
-  out = np.zeros(shape,dtype='float32')
+  if(ck is not None and ck.has(rkey)):
+    out = ck.restore(rkey)
+  else:
+    out = alloc_output(shape,'float32',outfile)
   chunks,nhx = False,1
   if(len(shape) > 3):
     chunks = True
     nhx = shape[1]
   nouts = []
-  # Send and sum over collected results
-  while(len(nouts)//nhx < n):
-    rdict = recv_zipped_pickle(socket)
-    if(rdict['msg'] == "available"):
-      # Send work
-      send_next_chunk(socket,gen,zlevel=zlevel)
-    elif(rdict['msg'] == "result"):
-      nouts.append(rdict[ckey])
+  # Accumulators (one per thread that needs one) and their chunks
+  shards = queue.LifoQueue()
+  shards.put([out,[]])
+  nshards = 1
+  if(outfile is None):
+    for ithr in range(nthreads-1): shards.put([None,[]])
+    nshards = max(nthreads,1)
+
+  def accumulate(rdict):
+    shard = shards.get()
+    if(shard[0] is None):
+      shard[0] = np.zeros(shape,dtype='float32')
+    try:
+      sum_result(shard[0],rdict,rkey,ikey,chunks)
+      if(rdict.get('_partial',False)):
+        shard[1] += rdict['_cids']
+        return rdict['_cids']
+      shard[1].append(rdict.get('_cid'))
+      return [rdict[ckey]]
+    finally:
+      shards.put(shard)
+
+  def save():
+    # Take all accumulators so that the sum and its chunks agree
+    held = [shards.get() for ishd in range(nshards)]
+    try:
+      cids = []
+      for shard in held:
+        # Merged in place into the output (allocated again on the next result)
+        if(shard[0] is not None and shard[0] is not out):
+          np.add(out,shard[0],out=out)
+          shard[0] = None
+        cids += shard[1]
+      # The sum (and a memory-mapped output) is saved in a snapshot
+      # so that the results added after the checkpoint are not kept
+      ck.save(cids,{rkey: out},accumulated=True)
+      # Only the chunks of the next checkpoint are kept
+      for shard in held: shard[1] = []
+    finally:
+      for shard in held: shards.put(shard)
+
+  # Send and sum over collected results (skipping the completed chunks)
+  nskip = 0 if(ck is None) else len(ck.cids)
+  disp = dispatcher(gen,None,zlevel,oob,codec,prefetch,batch,speculate,lease,
+                    None if(ck is None) else ck.cids,shared)
+  try:
+    for iouts in dstr_results(n*nhx-nskip,disp,socket,credits=credits,nthreads=nthreads,
+                              func=accumulate,stats=stats):
+      nouts += iouts
+      if(nflush is not None and len(nouts)%nflush < len(iouts)):
+        flush_outputs({rkey: out})
+      if(ck is not None and ck.due()):
+        save()
+  finally:
+    # Also saved if interrupted
+    if(ck is not None): save()
+
+  # Merge the accumulators
+  while(not shards.empty()):
+    acc = shards.get()[0]
+    if(acc is not None and acc is not out):
+      out += acc
+  flush_outputs({rkey: out})
+
+  return out
+
+def sum_result(acc,rdict,rkey,ikey='idx',chunks=False) -> None:
+  """
+  Adds a result to an accumulator
+
+  Parameters:
+    acc    - the output array
+    rdict  - a result (or a partial sum returned by a worker)
+    rkey   - the result key to be summed
+    ikey   - key for the index for chunked transfer ['idx']
+    chunks - the results are summed in acc[0,rdict[ikey]] [False]
+  """
+  if(rdict.get('_partial',False)):
+    # A sum over several chunks done on the worker
+    for idx,res in rdict[rkey].items():
       if(chunks):
-        out[0,rdict[ikey]] += rdict[rkey]
+        acc[0,idx] += res
       else:
-        out += rdict[rkey]
-      socket.send(b"")
+        acc += res
+    return
+  if(chunks):
+    acc[0,rdict[ikey]] += rdict[rkey]
+  else:
+    acc += rdict[rkey]
 
-  return out
+def dstr_imap_unordered(n,gen,socket,zlevel=-1,oob=False,credits=None,nthreads=0,codec=None,
+                        stats=None,prefetch=0,batch=None,speculate=0,lease=None,shared=None):
+  """
+  Distributes data to workers and yields the results
+  in the order in which they arrive. Nothing is kept
+  on the server after a result has been yielded
+
+  Parameters:
+    n        - length of input generator
+    gen      - an input generator that gives a chunk (a dictionary)
+    socket   - a ZMQ socket (REP or ROUTER)
+    zlevel   - level of compression [-1]
+    oob      - send and receive arrays as out-of-band frames [False]
+    credits  - maximum number of chunks in flight per worker
+               (ROUTER socket only) [None]
+    nthreads - decode the results in a pool of nthreads threads [0]
+    codec    - name of a codec (comm.sendrecv.get_codecs), 'auto' to
+               select one for each frame or 'adapt' to tune it online
+               (overrides zlevel and oob) [None]
+    stats    - a dictionary to be filled with statistics of the run
+               (e.g., the codec chosen with 'adapt') [None]
+    prefetch - number of chunks pulled from the generator and encoded
+               ahead of demand in background threads so that workers
+               are answered immediately [0]
+    batch    - number of consecutive chunks sent to a worker in a single
+               message or 'auto' to batch small chunks up to about 1 MB.
+               The results are returned in a single message and unpacked
+               on the server [None]
+    speculate - once all chunks are handed out, send up to speculate
+                extra copies of the slowest outstanding chunks to idle
+                workers and keep the first result to arrive. Not to be
+                used with partial sums on the workers [0]
+    lease     - number of seconds a worker may keep a chunk before it
+                is handed out to another worker (e.g., if the worker
+                was lost). The first result to arrive is kept [None]
+    shared    - a broadcaster of objects needed by every chunk. The objects
+                are sent once to each worker and given in chunk[name]
+                (server.broadcast) [None]
+
+  Yields a tuple (index,result) in which index is the position
+  of the chunk in the input generator and result is the dictionary
+  returned by the worker
+  """
+  for rdict in dstr_results(n,gen,socket,zlevel,oob,credits,nthreads,codec=codec,stats=stats,
+                            prefetch=prefetch,batch=batch,speculate=speculate,
+                            lease=lease,shared=shared):
+    yield rdict['_cid'], rdict
+
+def dstr_imap(n,gen,socket,zlevel=-1,oob=False,credits=None,maxbuf=None,nthreads=0,codec=None,
+              stats=None,prefetch=0,batch=None,speculate=0,lease=None,shared=None):
+  """
+  Distributes data to workers and yields the results
+  in the order of the input generator. Results that arrive
+  early are kept in a reorder buffer
+
+  Parameters:
+    n        - length of input generator
+    gen      - an input generator that gives a chunk (a dictionary)
+    socket   - a ZMQ socket (REP or ROUTER)
+    zlevel   - level of compression [-1]
+    oob      - send and receive arrays as out-of-band frames [False]
+    credits  - maximum number of chunks in flight per worker
+               (ROUTER socket only) [None]
+    maxbuf   - maximum number of results in the reorder buffer.
+               Chunks are not handed out further than maxbuf ahead
+               of the next result to be yielded [None, unbounded]
+    nthreads - decode the results in a pool of nthreads threads [0]
+    codec    - name of a codec (comm.sendrecv.get_codecs), 'auto' to
+               select one for each frame or 'adapt' to tune it online
+               (overrides zlevel and oob) [None]
+    stats    - a dictionary to be filled with statistics of the run
+               (e.g., the codec chosen with 'adapt') [None]
+    prefetch - number of chunks pulled from the generator and encoded
+               ahead of demand in background threads so that workers
+               are answered immediately [0]
+    batch    - number of consecutive chunks sent to a worker in a single
+               message or 'auto' to batch small chunks up to about 1 MB.
+               The results are returned in a single message and unpacked
+               on the server [None]
+    speculate - once all chunks are handed out, send up to speculate
+                extra copies of the slowest outstanding chunks to idle
+                workers and keep the first result to arrive. Not to be
+                used with partial sums on the workers [0]
+    lease     - number of seconds a worker may keep a chunk before it
+                is handed out to another worker (e.g., if the worker
+                was lost). The first result to arrive is kept [None]
+    shared    - a broadcaster of objects needed by every chunk. The objects
+                are sent once to each worker and given in chunk[name]
+                (server.broadcast) [None]
+
+  Yields a tuple (index,result) in which index is the position
+  of the chunk in the input generator and result is the dictionary
+  returned by the worker
+  """
+  window = maxbuf + 1 if(maxbuf is not None) else None
+  disp = dispatcher(gen,window,zlevel,oob,codec,prefetch,batch,speculate,lease,shared=shared)
+  rbuf = {}
+  for rdict in dstr_results(n,disp,socket,credits=credits,nthreads=nthreads,stats=stats):
+    rbuf[rdict['_cid']] = rdict
+    # Yield all results that are now in order
+    while(disp.base in rbuf):
+      yield disp.base, rbuf.pop(disp.base)
+      disp.base += 1
+
+def dstr_results(nres,gen,socket,zlevel=-1,oob=False,credits=None,nthreads=0,func=None,codec=None,
+                 stats=None,prefetch=0,batch=None,speculate=0,lease=None,decode=True,shared=None):
+  """
+  Distributes data to workers and yields the results
+  as they are received. Dispatches to the ROUTER engine
+  (server.router) if given a ROUTER socket
+
+  Parameters:
+    nres     - number of results to receive
+    gen      - an input generator that gives a chunk (or a dispatcher)
+    socket   - a ZMQ socket (REP or ROUTER)
+    zlevel   - level of compression [-1]
+    oob      - send arrays as out-of-band frames [False]
+    credits  - maximum number of chunks in flight per worker
+               (ROUTER socket only) [None]
+    nthreads - decode the results (and apply func) in a pool of
+               nthreads threads. The socket loop only reads the control
+               envelope of each result and keeps serving workers [0]
+    func     - a function applied to each result dictionary [None]
+    codec    - name of a codec or 'auto' (overrides zlevel and oob) [None]
+    stats    - a dictionary to be filled with statistics of the run [None]
+    prefetch - number of chunks pulled from the generator and encoded
+               ahead of demand in background threads [0]
+    batch    - number of chunks sent in a single message or 'auto' [None]
+    speculate - number of speculative copies of the slowest chunks [0]
+    lease     - number of seconds a worker may keep a chunk [None]
+    shared    - a broadcaster of objects shared by all chunks [None]
+    decode    - decode the results. If False, the control dictionary
+                and the frames of each message are yielded [True]
+
+  If gen is a dispatcher, zlevel, oob, codec, prefetch, batch, speculate,
+  lease and shared are those of the dispatcher
+
+  Yields the result dictionaries returned by the workers
+  (or the output of func)
+  """
+  if(isinstance(gen,dispatcher)):
+    disp = gen
+  else:
+    disp = dispatcher(gen,zlevel=zlevel,oob=oob,codec=codec,prefetch=prefetch,batch=batch,
+                      speculate=speculate,lease=lease,shared=shared)
+  if(socket.type == zmq.ROUTER):
+    msgs = rtr_messages(nres,disp,socket,credits)
+  else:
+    msgs = rep_messages(nres,disp,socket)
+  try:
+    if(not decode):
+      yield from msgs
+    elif(nthreads > 0):
+      for outs in pool_results(msgs,nthreads,func,disp):
+        yield from outs
+    else:
+      for ctl,frames in msgs:
+        yield from decode_result(ctl,frames,func)
+  finally:
+    disp.close()
+  if(stats is not None):
+    stats.update(disp.stats())
+
+def rep_messages(nres,disp,socket):
+  """
+  Distributes data to workers over a REP socket and yields
+  the results as they are received without decoding them
+
+  Parameters:
+    nres   - number of results to receive
+    disp   - a dispatcher giving the chunks (server.dispatch)
+    socket - a bound ZMQ REP socket
+
+  Yields the control dictionary of each result and its frames
+  (None if the control dictionary is the whole result)
+  """
+  ires = 0
+  while(ires < nres):
+    # Chunks of expired leases go to the next worker to ask
+    disp.expire()
+    if(not socket.poll(disp.timeout())): continue
+    # Talk to client
+    frames = socket.recv_multipart(copy=False)
+    ctl,whole = loads_ctl(frames)
+    if(ctl['msg'] == "available"):
+      # The worker may have kept the result of a chunk
+      if(('_cid' in ctl or '_cids' in ctl) and not disp.stale(ctl)):
+        disp.reported(result_cids(ctl))
+      # Send work
+      socket.send_multipart(disp.encode(disp.next()),copy=False)
+    elif(ctl['msg'] == "fetch"):
+      # Send a shared object
+      socket.send_multipart(disp.fetch(ctl),copy=False)
+    elif(ctl['msg'] == "result" and disp.stale(ctl)):
+      # A late result of another job
+      reply_result(socket,ctl,disp)
+      release_frames(frames)
+    elif(ctl['msg'] == "result"):
+      new = disp.received(ctl)
+      # Send the next chunk or a "thank you" back
+      reply_result(socket,ctl,disp)
+      # Discard the duplicates of speculative copies
+      if(len(new) == 0):
+        release_frames(frames)
+        continue
+      if(len(new) < len(result_cids(ctl))):
+        ctl['_keep'] = new
+      ires += len(new)
+      yield ctl, None if(whole) else frames
+
+def decode_result(ctl,frames,func=None):
+  """
+  Decodes a result yielded by rep_messages or rtr_messages
+  and applies func to it (if provided)
+
+  Returns a list of the results in the message (several
+  if the result is a batch) or of the outputs of func
+  """
+  rdicts = decode_message(ctl,frames)
+  return rdicts if(func is None) else [func(irdict) for irdict in rdicts]
+
+def pool_results(msgs,nthreads,func=None,disp=None):
+  """
+  Decodes the results in a thread pool (lz4 and numpy release the GIL)
+  so that the socket loop is not blocked. At most 2*nthreads results
+  are waiting to be decoded at any time
+
+  Parameters:
+    msgs     - a generator of results (rep_messages or rtr_messages)
+    nthreads - number of threads in the pool
+    func     - a function applied to each result dictionary [None]
+    disp     - the dispatcher of msgs. If it is held (e.g., by a reorder
+               window), all pending results are yielded [None]
+
+  Yields the lists of decoded results (or of the outputs of func)
+  """
+  pending = deque()
+  with ThreadPoolExecutor(nthreads) as pool:
+    for ctl,frames in msgs:
+      pending.append(pool.submit(decode_result,ctl,frames,func))
+      while(len(pending) > 0 and (pending[0].done() or len(pending) >= 2*nthreads or
+                                  (disp is not None and disp.held()))):
+        yield pending.popleft().result()
+    while(len(pending) > 0):
+      yield pending.popleft().result()
+
+def reply_result(socket,rdict,disp):
+  """
+  Replies to a worker that returned a result. If the worker
+  asked for more work within the result (rdict['next'] is True)
+  the reply is the next chunk (or an empty end-of-work chunk),
+  saving a round trip. Otherwise a "thank you" is sent
+
+  Parameters:
+    socket - a ZMQ socket
+    rdict  - the result received from the worker
+    disp   - the dispatcher giving the next chunk
+  """
+  if(rdict.get('next',False)):
+    socket.send_multipart(disp.encode(disp.next()),copy=False)
+  else:
+    socket.send(b"")
+
+def alloc_output(shape,dtype='float32',fname=None):
+  """
+  Allocates a zeroed output array
+
+  Parameters:
+    shape - the shape of the array
+    dtype - the type of the array ['float32']
+    fname - the name of a file to memory map. The pages of the
+            array are then written to the file by the operating
+            system and do not need to fit in memory [None]
+
+  Returns the output array (a np.memmap if fname is given)
+  """
+  if(fname is None):
+    return np.zeros(shape,dtype=dtype)
+  return np.memmap(fname,dtype=dtype,mode='w+',shape=shape)
 
+def flush_outputs(odict) -> None:
+  """ Flushes the memory-mapped arrays of a dictionary to disk """
+  for oarr in odict.values():
+    if(isinstance(oarr,np.memmap)):
+      oarr.flush()
@@ -0,0 +1,79 @@
+"""
+Submits successive jobs to the same live workers by
+shipping the function of each job with the chunks
+
+@author: Joseph Jennings
+@version: 2020.10.18
+"""
+from server.broadcast import broadcaster
+from server.distribute import dstr_collect, dstr_sum, dstr_imap_unordered, dstr_imap
+try:
+  import cloudpickle
+except ImportError:
+  cloudpickle = None
+
+class workpool:
+  """
+  A pool of generic workers (client.worker.shipped) connected to a
+  server socket. The function of each job is serialized with cloudpickle
+  and shared with the chunks (server.broadcast), so each worker receives
+  it once (cached by its content hash) and the same workers can run many
+  jobs without being relaunched. Each job tags its chunks with its own id,
+  so late results of a previous job (e.g., an imap stopped early) are discarded
+  """
+
+  def __init__(self,socket,shared=None,**kwargs):
+    """
+    workpool constructor
+
+    Parameters:
+      socket - a bound ZMQ socket (REP or ROUTER) to which the workers connect
+      shared - a broadcaster through which the functions (and other shared
+               objects) are sent [None, a new broadcaster]
+      kwargs - default arguments of the jobs (e.g., codec='auto', batch=4)
+    """
+    if(cloudpickle is None):
+      raise Exception("Please install cloudpickle to ship functions to the workers")
+    self.socket = socket
+    self.shared = shared if(shared is not None) else broadcaster()
+    self.kwargs = kwargs
+
+  def ship(self,func):
+    """
+    Sets the function applied by the workers to the next chunks
+
+    Parameters:
+      func - a function that takes a chunk and returns a dictionary
+             of results (closures and lambdas are allowed)
+
+    Returns the content hash of the function
+    """
+    return self.shared.register('_func',cloudpickle.dumps(func))
+
+  def args(self,kwargs):
+    """
+    Returns the arguments of a job. The shared objects (and the
+    function) are pinned now, so a job started later (e.g., an
+    imap consumed after another job was submitted) keeps its own
+    """
+    return dict(self.kwargs,shared=self.shared.pin(),**kwargs)
+
+  def collect(self,func,keys,n,gen,**kwargs):
+    """ Applies func to the chunks and collects the results (see dstr_collect) """
+    self.ship(func)
+    return dstr_collect(keys,n,gen,self.socket,**self.args(kwargs))
+
+  def sum(self,func,ckey,rkey,n,gen,shape,**kwargs):
+    """ Applies func to the chunks and sums the results (see dstr_sum) """
+    self.ship(func)
+    return dstr_sum(ckey,rkey,n,gen,self.socket,shape,**self.args(kwargs))
+
+  def imap_unordered(self,func,n,gen,**kwargs):
+    """ Applies func to the chunks and yields the results as they arrive (see dstr_imap_unordered) """
+    self.ship(func)
+    return dstr_imap_unordered(n,gen,self.socket,**self.args(kwargs))
+
+  def imap(self,func,n,gen,**kwargs):
+    """ Applies func to the chunks and yields the results in order (see dstr_imap) """
+    self.ship(func)
+    return dstr_imap(n,gen,self.socket,**self.args(kwargs))
@@ -0,0 +1,155 @@
+"""
+A ROUTER based engine for distributing work.
+Unlike the REP socket, a ROUTER socket can serve many
+workers at once and each worker (a DEALER socket) can
+hold several chunks in flight (its credits) so that its
+computation never waits on the network
+
+@author: Joseph Jennings
+@version: 2020.09.20
+"""
+from comm.sendrecv import loads_ctl, release_frames
+from server.dispatch import result_cids, chunk_cids
+from collections import deque
+
+def rtr_messages(nres,disp,socket,credits=None):
+  """
+  Distributes data to workers over a ROUTER socket
+  and yields the results as they are received
+  without decoding them.
+
+  Each "available" message from a worker is a credit for
+  one chunk. A result with rdict['next'] set returns the credit.
+  Credits that cannot be served (no work at the moment or
+  the worker is at its limit) are held and served when possible.
+  Once the work is exhausted, each worker is sent a single
+  empty end-of-work chunk (so it can return partial results)
+  and the held credits are answered at the end
+
+  Parameters:
+    nres    - number of results to receive
+    disp    - a dispatcher giving the chunks (server.dispatch)
+    socket  - a bound ZMQ ROUTER socket
+    credits - maximum number of chunks in flight per worker
+              [None, as many as requested by the worker]
+
+  Yields the control dictionary of each result and its frames
+  (None if the control dictionary is the whole result)
+  """
+  sched = rtrsched(socket,disp,credits)
+  ires = 0
+  while(ires < nres):
+    # Hand out again the chunks of expired leases
+    disp.expire()
+    # Serve the held credits if possible
+    sched.serve_waiting()
+    if(not socket.poll(disp.timeout())): continue
+    frames = socket.recv_multipart(copy=False)
+    wid,frames = frames[0].bytes, frames[1:]
+    ctl,whole = loads_ctl(frames)
+    disp.heard(wid)
+    if(ctl['msg'] == "available"):
+      # The worker may have kept the result of a chunk
+      if(('_cid' in ctl or '_cids' in ctl) and not disp.stale(ctl)):
+        disp.reported(result_cids(ctl),wid)
+        sched.complete(wid,result_cids(ctl))
+      sched.request(wid)
+    elif(ctl['msg'] == "fetch"):
+      # Send a shared object
+      socket.send_multipart([wid] + disp.fetch(ctl),copy=False)
+    elif(ctl['msg'] == "result" and disp.stale(ctl)):
+      # A late result of another job
+      release_frames(frames)
+      if(ctl.get('next',False)):
+        sched.request(wid)
+    elif(ctl['msg'] == "result"):
+      new = disp.received(ctl,wid)
+      cids = result_cids(ctl)
+      sched.complete(wid,cids)
+      if(ctl.get('next',False)):
+        sched.request(wid)
+      # Discard the duplicates of speculative copies
+      if(len(new) == 0):
+        release_frames(frames)
+        continue
+      if(len(new) < len(cids)):
+        ctl['_keep'] = new
+      ires += len(new)
+      yield ctl, None if(whole) else frames
+  # Tell the waiting workers there is no more work
+  sched.release()
+
+class rtrsched:
+  """
+  Keeps track of the chunks outstanding on each worker
+  of a ROUTER socket
+  """
+
+  def __init__(self,socket,disp,credits=None):
+    """
+    rtrsched constructor
+
+    Parameters:
+      socket  - a bound ZMQ ROUTER socket
+      disp    - a dispatcher giving the chunks (server.dispatch)
+      credits - maximum number of chunks in flight per worker [None]
+    """
+    self.socket  = socket
+    self.disp    = disp
+    self.credits = credits
+    # Chunk ids outstanding on each worker (mapped to the
+    # first chunk id of their message)
+    self.outstanding = {}
+    # Credits that could not be served
+    self.waiting = deque()
+    # Workers that were told the work is exhausted
+    self.ended = set()
+
+  def send(self,wid,chunk) -> None:
+    """ Sends a chunk to the worker with identity wid """
+    self.socket.send_multipart([wid] + self.disp.encode(chunk), copy=False)
+
+  def request(self,wid) -> bool:
+    """
+    Serves a credit from worker wid. Returns False if
+    the credit could not be served and is held
+    """
+    wout = self.outstanding.setdefault(wid,{})
+    # A credit is a message (a chunk or a batch of chunks)
+    if(self.credits is not None and len(set(wout.values())) >= self.credits):
+      self.waiting.append(wid)
+      return False
+    chunk = self.disp.next(wid)
+    if(chunk == {}):
+      if(self.disp.done and wid not in self.ended):
+        # Tell the worker (once) that there is no more work
+        self.ended.add(wid)
+        self.send(wid,chunk)
+      else:
+        self.waiting.append(wid)
+      return False
+    cids = chunk_cids(chunk)
+    for cid in cids:
+      wout[cid] = cids[0]
+    # A chunk handed out again after the end (e.g., an expired lease)
+    # needs another end-of-work chunk for a partial sum to be returned
+    self.ended.discard(wid)
+    self.send(wid,chunk)
+    return True
+
+  def complete(self,wid,cids) -> None:
+    """ Marks the chunks cids as completed by worker wid """
+    wout = self.outstanding.get(wid,{})
+    for cid in cids:
+      wout.pop(cid,None)
+
+  def serve_waiting(self) -> None:
+    """ Tries to serve each held credit once """
+    for iwait in range(len(self.waiting)):
+      if(not self.disp.done and self.disp.held()): break
+      self.request(self.waiting.popleft())
+
+  def release(self) -> None:
+    """ Answers all held credits with an end-of-work chunk """
+    while(len(self.waiting) > 0):
+      self.send(self.waiting.popleft(),{})
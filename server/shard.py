@@ -0,0 +1,164 @@
+"""
+A sharded server: several collector processes, each serving
+a slice of the workers on its own address, decode the results
+and write them in shared memory while a single dispatcher
+hands out the chunks
+
+@author: Joseph Jennings
+@version: 2020.10.16
+"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import zmq
+from client.aggregator import aggregator
+from server.distribute import dstr_results, sum_result
+
+def shard_collect(keys,n,gen,addresses,outputs,zlevel=-1,oob=False,codec=None,stats=None,
+                  prefetch=0,batch=None):
+  """
+  Distributes data to workers connected to several collector
+  processes and collects the results in output arrays
+
+  Parameters:
+    keys      - list of keys to expect to receive from client
+    n         - length of input generator
+    gen       - an input generator that gives a chunk
+    addresses - the addresses to which the collectors bind (one collector
+                per address, e.g., ["tcp://*:5555","tcp://*:5556"]). Each
+                worker connects to one of them (DEALER or REQ socket)
+    outputs   - a dictionary of the shape and type of the output array of
+                each key, e.g. {'result': ((n,nz,nx),'float32')}. The result
+                of each chunk is written at its index in the input generator
+    zlevel    - level of compression [-1]
+    oob       - send arrays as out-of-band frames [False]
+    codec     - name of a codec, 'auto' or 'adapt' (overrides zlevel and oob) [None]
+    stats     - a dictionary to be filled with statistics of the run [None]
+    prefetch  - number of chunks encoded ahead of demand [0]
+    batch     - number of chunks sent in a single message or 'auto' [None]
+
+  The collectors are started with the spawn method (the calling
+  script must be guarded with if __name__ == '__main__')
+
+  Returns a dictionary with keys of keys and the output arrays
+  """
+  shms,arrays = {},{}
+  try:
+    for ikey in keys:
+      oshape,otype = outputs[ikey][:2]
+      size = int(np.prod(oshape))*np.dtype(otype).itemsize
+      shms[ikey] = shared_memory.SharedMemory(create=True,size=max(size,1))
+      arrays[ikey] = (shms[ikey].name,oshape,otype)
+    spec = {'mode': 'collect', 'arrays': arrays}
+    run_shards(n,gen,addresses,spec,zlevel,oob,codec,stats,prefetch,batch)
+    # Copy the outputs out of shared memory
+    odict = {}
+    for ikey,(name,oshape,otype) in arrays.items():
+      odict[ikey] = np.array(np.ndarray(oshape,dtype=otype,buffer=shms[ikey].buf))
+  finally:
+    for shm in shms.values():
+      shm.close(); shm.unlink()
+
+  return odict
+
+def shard_sum(rkey,n,gen,addresses,shape,ikey='idx',zlevel=-1,oob=False,codec=None,stats=None,
+              prefetch=0,batch=None):
+  """
+  Distributes data to workers connected to several collector
+  processes and sums over the results. Each collector sums its
+  results in its own output array (in shared memory) and the
+  arrays are summed at the end
+
+  Parameters:
+    rkey      - a result key for summing the results
+    n         - length of input generator
+    gen       - an input generator that gives a chunk
+    addresses - the addresses to which the collectors bind (one collector
+                per address). Each worker connects to one of them
+    shape     - the shape of the output array
+    ikey      - key for sending the index for chunked transfer ['idx']
+    zlevel    - level of compression [-1]
+    oob       - send arrays as out-of-band frames [False]
+    codec     - name of a codec, 'auto' or 'adapt' (overrides zlevel and oob) [None]
+    stats     - a dictionary to be filled with statistics of the run [None]
+    prefetch  - number of chunks encoded ahead of demand [0]
+    batch     - number of chunks sent in a single message or 'auto' [None]
+
+  The collectors are started with the spawn method (the calling
+  script must be guarded with if __name__ == '__main__')
+
+  Returns:
+    Sums over the work returned by workers to give an
+    output array of size shape
+  """
+  nhx = shape[1] if(len(shape) > 3) else 1
+  nshards = len(addresses)
+  size = nshards*int(np.prod(shape))*4
+  shm = shared_memory.SharedMemory(create=True,size=max(size,1))
+  try:
+    # Zero the accumulators
+    np.ndarray((nshards,)+tuple(shape),dtype='float32',buffer=shm.buf)[:] = 0
+    spec = {'mode': 'sum', 'name': shm.name, 'shape': tuple(shape), 'nshards': nshards,
+            'rkey': rkey, 'ikey': ikey}
+    run_shards(n*nhx,gen,addresses,spec,zlevel,oob,codec,stats,prefetch,batch)
+    out = np.ndarray((nshards,)+tuple(shape),dtype='float32',buffer=shm.buf).sum(axis=0)
+  finally:
+    shm.close(); shm.unlink()
+
+  return out
+
+def run_shards(nres,gen,addresses,spec,zlevel=-1,oob=False,codec=None,stats=None,prefetch=0,
+               batch=None) -> None:
+  """
+  Starts a collector process per address and hands out the
+  chunks to the collectors until nres results are done
+  """
+  context = zmq.Context.instance()
+  socket = context.socket(zmq.ROUTER)
+  port = socket.bind_to_random_port("tcp://127.0.0.1")
+  backaddr = "tcp://127.0.0.1:%d"%(port)
+  ctx = mp.get_context('spawn')
+  procs = [ctx.Process(target=collector,args=(address,backaddr,spec,ishard),daemon=True)
+           for ishard,address in enumerate(addresses)]
+  for proc in procs: proc.start()
+  try:
+    # The collectors only return the indices of the chunks that are done
+    for rdict in dstr_results(nres,gen,socket,zlevel,oob,codec=codec,stats=stats,
+                              prefetch=prefetch,batch=batch):
+      pass
+  finally:
+    for proc in procs:
+      proc.terminate(); proc.join()
+    socket.close(linger=0)
+
+def collector(address,backaddr,spec,ishard) -> None:
+  """
+  A collector process: serves the workers connected to address
+  and writes their results in shared memory (see spec)
+  """
+  shms = []
+  def attach(name,shape,dtype):
+    shms.append(shared_memory.SharedMemory(name=name))
+    return np.ndarray(shape,dtype=dtype,buffer=shms[-1].buf)
+
+  if(spec['mode'] == 'sum'):
+    acc = attach(spec['name'],(spec['nshards'],)+spec['shape'],'float32')[ishard]
+    rkey,ikey,chunks = spec['rkey'],spec['ikey'],len(spec['shape']) > 3
+    def sink(rdict):
+      sum_result(acc,rdict,rkey,ikey,chunks)
+  else:
+    arrays = {}
+    for ikey,(name,oshape,otype) in spec['arrays'].items():
+      arrays[ikey] = attach(name,oshape,otype)
+    def sink(rdict):
+      for ikey,arr in arrays.items():
+        arr[rdict['_cid']] = rdict[ikey]
+
+  context = zmq.Context()
+  frontend = context.socket(zmq.ROUTER)
+  frontend.bind(address)
+  backend = context.socket(zmq.DEALER)
+  backend.connect(backaddr)
+  fetcher = context.socket(zmq.DEALER)
+  fetcher.connect(backaddr)
+  aggregator(frontend,backend,fetcher=fetcher,sink=sink)
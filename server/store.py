@@ -0,0 +1,149 @@
+"""
+Stores the results received from the workers as they were
+received (compressed frames) and decodes them on access
+
+@author: Joseph Jennings
+@version: 2020.10.07
+"""
+from collections import OrderedDict
+from comm.sendrecv import loads_frames, needs_decode
+from server.dispatch import result_cids
+
+def decode_message(ctl,frames):
+  """
+  Decodes a result message (the control dictionary and the
+  frames yielded by rep_messages or rtr_messages)
+
+  Returns the list of results in the message (several if
+  the result is a batch)
+  """
+  rdict = ctl if(frames is None) else loads_frames(frames)
+  rdicts = rdict['_batch'] if('_batch' in rdict) else [rdict]
+  if('_batch' in rdict and '_job' in rdict):
+    # Each result of a batch belongs to the job of the batch
+    for irdict in rdicts:
+      irdict.setdefault('_job',rdict['_job'])
+  if('_keep' in ctl):
+    # Some results of the batch were already received
+    rdicts = [irdict for irdict in rdicts if(irdict['_cid'] in ctl['_keep'])]
+  return rdicts
+
+def message_size(ctl):
+  """ Returns the number of results kept in a message """
+  if('_keep' in ctl):
+    return len(ctl['_keep'])
+  return len(result_cids(ctl))
+
+class resultstore:
+  """
+  Keeps the messages of the results without decoding
+  them. A result is decoded when it is accessed (except
+  messages that must be decoded once, e.g., codec 'shm',
+  which are decoded when added)
+  """
+
+  def __init__(self,cache=0):
+    """
+    resultstore constructor
+
+    Parameters:
+      cache - number of decoded messages kept in a
+              least-recently-used cache [0]
+    """
+    self.msgs   = []
+    # Message and position within the message of each result
+    self.index  = []
+    self.ncache = cache
+    self.cache  = OrderedDict()
+
+  def add(self,ctl,frames):
+    """
+    Adds a message to the store
+
+    Parameters:
+      ctl    - the control dictionary of the message
+      frames - the frames of the message (None if ctl is the whole result)
+
+    Returns the number of results in the message
+    """
+    nres = message_size(ctl)
+    if(frames is not None and needs_decode(frames)):
+      # Kept decoded (the whole result is the control dictionary)
+      ctl,frames = dict(loads_frames(frames),**ctl),None
+    imsg = len(self.msgs)
+    self.msgs.append((ctl,frames))
+    for ires in range(nres):
+      self.index.append((imsg,ires))
+    return nres
+
+  def decode(self,imsg):
+    """ Returns the decoded results of a message """
+    if(imsg in self.cache):
+      self.cache.move_to_end(imsg)
+      return self.cache[imsg]
+    rdicts = decode_message(*self.msgs[imsg])
+    if(self.ncache > 0):
+      self.cache[imsg] = rdicts
+      if(len(self.cache) > self.ncache):
+        self.cache.popitem(last=False)
+    return rdicts
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self,i):
+    if(isinstance(i,slice)):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    imsg,ires = self.index[i]
+    return self.decode(imsg)[ires]
+
+  def __iter__(self):
+    # Each message is decoded once
+    for imsg in range(len(self.msgs)):
+      yield from self.decode(imsg)
+
+  def messages(self,beg=0):
+    """ Returns the messages from beg (frames as bytes so they can be pickled) """
+    msgs = []
+    for ctl,frames in self.msgs[beg:]:
+      if(frames is not None):
+        frames = [frame.bytes if(hasattr(frame,'bytes')) else bytes(frame) for frame in frames]
+      msgs.append((ctl,frames))
+    return msgs
+
+  def __getstate__(self):
+    # Frames received without a copy are saved as bytes
+    return {'msgs': self.messages(), 'index': self.index, 'ncache': self.ncache}
+
+  def __setstate__(self,state):
+    self.__dict__.update(state)
+    self.cache = OrderedDict()
+
+class lazylist:
+  """
+  A list of the values of one key of the results
+  in a resultstore (decoded on access)
+  """
+
+  def __init__(self,store,key):
+    """
+    lazylist constructor
+
+    Parameters:
+      store - a resultstore
+      key   - the key of the results
+    """
+    self.store = store
+    self.key   = key
+
+  def __len__(self):
+    return len(self.store)
+
+  def __getitem__(self,i):
+    if(isinstance(i,slice)):
+      return [rdict[self.key] for rdict in self.store[i]]
+    return self.store[i][self.key]
+
+  def __iter__(self):
+    for rdict in self.store:
+      yield rdict[self.key]
@@ -1,4 +1,6 @@
 from server.distribute import dstr_collect, dstr_sum
+from server.pool import workpool
+from server.utils import startrouter
 from client.sshworkers import launch_sshworkers, kill_sshworkers
 
 # Start workers
@@ -21,6 +23,12 @@ okeys = ['result','other'] # Tell client which keys to return
 output = dstr_collect(okeys,nimg,chunks,socket)
 # Distribute work and sum
 #output = dstr_sum('scale','result',nimg,chunks,socket,6000000)
+# With generic workers (client/generictemplate.py), ship the function of each job.
+# Those workers use DEALER sockets and need a ROUTER server (REQ workers, req_worker,
+# pair with the REP socket above)
+#context,socket = startrouter("tcp://0.0.0.0:5555")
+#pool = workpool(socket)
+#output = pool.collect(foo,okeys,nimg,chunks)
 
 # Process received output
 print(output['scale'])
@@ -0,0 +1,115 @@
+"""
+Online tuning of the codec used for sending chunks and results
+
+@author: Joseph Jennings
+@version: 2020.09.28
+"""
+import time
+
+class codectuner:
+  """
+  Chooses the codec that minimizes the time spent per chunk
+  outside of the computation on the worker.
+
+  For each chunk, the time from encoding on the server to the
+  arrival of its result, minus the compute time reported by the
+  worker, is the cost of the codec (encoding, transfers and decoding
+  in both directions). It is normalized by the size of the chunk
+  and averaged per codec. Each codec is first tried nexplore times,
+  then the cheapest is used, with one chunk out of every nretry
+  used to measure the least observed codec again
+  """
+
+  def __init__(self,codecs=None,nexplore=2,nretry=20,alpha=0.3):
+    """
+    codectuner constructor
+
+    Parameters:
+      codecs   - list of candidate codecs [None, a default list
+                 of the codecs that every host has. The zstd codecs
+                 can be added if all the workers have zstandard]
+      nexplore - number of chunks to try with each codec first [2]
+      nretry   - measure again the least observed codec
+                 every nretry chunks [20]
+      alpha    - weight of a new measurement in the averages [0.3]
+    """
+    if(codecs is None):
+      codecs = ['none','lz4','lz4-9','shuffle-lz4']
+    self.codecs   = codecs
+    self.nexplore = nexplore
+    self.nretry   = nretry
+    self.alpha    = alpha
+    # Average cost in seconds per MB of chunk
+    self.cost   = {codec: None for codec in codecs}
+    self.nobs   = {codec: 0 for codec in codecs}
+    self.nsent  = {codec: 0 for codec in codecs}
+    # Totals for the compression ratio and throughput
+    self.raw    = {codec: 0 for codec in codecs}
+    self.nbytes = {codec: 0 for codec in codecs}
+    self.tenc   = {codec: 0.0 for codec in codecs}
+    # Chunks sent but not yet returned
+    self.inflight = {}
+    self.nchoice  = 0
+
+  def best(self):
+    """ Returns the codec with the smallest average cost """
+    obs = [codec for codec in self.codecs if(self.cost[codec] is not None)]
+    if(len(obs) == 0):
+      return self.codecs[0]
+    return min(obs,key=lambda codec: self.cost[codec])
+
+  def choose(self):
+    """ Returns the codec to use for the next chunk """
+    self.nchoice += 1
+    # Explore the codecs not tried often enough
+    for codec in self.codecs:
+      if(self.nsent[codec] < self.nexplore):
+        return codec
+    # Measure again from time to time as the link changes
+    if(self.nretry is not None and self.nchoice % self.nretry == 0):
+      return min(self.codecs,key=lambda codec: self.nobs[codec])
+    return self.best()
+
+  def sent(self,cid,codec,tenc,raw,nbytes) -> None:
+    """
+    Records that a chunk was encoded and sent
+
+    Parameters:
+      cid    - the chunk id
+      codec  - the codec used for the chunk
+      tenc   - time spent encoding the chunk (seconds)
+      raw    - size of the chunk before encoding (bytes)
+      nbytes - size of the chunk after encoding (bytes)
+    """
+    if(codec not in self.cost): return
+    self.nsent[codec]  += 1
+    self.raw[codec]    += raw
+    self.nbytes[codec] += nbytes
+    self.tenc[codec]   += tenc
+    self.inflight[cid] = (codec,time.time()-tenc,raw)
+
+  def received(self,cid,tcmp=0.0) -> None:
+    """
+    Records the arrival of the result of a chunk
+
+    Parameters:
+      cid  - the chunk id
+      tcmp - compute time reported by the worker (seconds) [0.0]
+    """
+    if(cid not in self.inflight): return
+    codec,tbeg,raw = self.inflight.pop(cid)
+    cost = max(time.time() - tbeg - tcmp,0.0)/max(raw/1e6,1e-6)
+    self.nobs[codec] += 1
+    if(self.cost[codec] is None):
+      self.cost[codec] = cost
+    else:
+      self.cost[codec] = (1-self.alpha)*self.cost[codec] + self.alpha*cost
+
+  def stats(self):
+    """ Returns the chosen codec and the measurements of each codec """
+    codecs = {}
+    for codec in self.codecs:
+      codecs[codec] = {'chunks': self.nsent[codec], 'cost': self.cost[codec],
+                       'ratio': self.raw[codec]/max(self.nbytes[codec],1),
+                       'encrate': self.raw[codec]/1e6/max(self.tenc[codec],1e-9)}
+    return {'codec': self.best(), 'codecs': codecs}
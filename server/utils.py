@@ -5,6 +5,7 @@ Utility functions for the server side
 @version: 2020.09.03
 """
 import zmq
+from comm.sendrecv import loads_ctl, dumps_frames, release_frames
 
 def splitnum(num,div):
   """ Splits a number into nearly even parts """
@@ -17,6 +18,90 @@ def splitnum(num,div):
 
   return splits
 
+def guidedsplit(num,div,minsize=1):
+  """
+  Splits a number into parts of decreasing size for guided
+  self-scheduling. Each part is the remainder divided by
+  the number of workers
+
+  Parameters:
+    num     - the number to split (e.g., the size of an axis)
+    div     - the number of workers
+    minsize - the minimum size of a part [1]
+
+  Returns a list of the sizes of the parts
+  """
+  splits = []
+  rem = num
+  while(rem > 0):
+    size = min(max(-(-rem//div),minsize),rem)
+    splits.append(size)
+    rem -= size
+
+  return splits
+
+def factorsplit(num,div,minsize=1,factor=2):
+  """
+  Splits a number into parts of decreasing size for factoring
+  self-scheduling. The parts are made in batches of div parts
+  of equal size, each batch covering 1/factor of the remainder
+
+  Parameters:
+    num     - the number to split (e.g., the size of an axis)
+    div     - the number of workers
+    minsize - the minimum size of a part [1]
+    factor  - the fraction of the remainder in each batch [2]
+
+  Returns a list of the sizes of the parts
+  """
+  splits = []
+  rem = num
+  while(rem > 0):
+    size = max(-(-rem//(factor*div)),minsize)
+    for i in range(div):
+      if(rem == 0): break
+      splits.append(min(size,rem))
+      rem -= splits[-1]
+
+  return splits
+
+def schedchunks(num,factory,div,sched='guided',minsize=1):
+  """
+  Splits a range of work into chunks whose sizes decrease
+  toward the end of the range so that the workers finish
+  at about the same time
+
+  Parameters:
+    num     - the size of the range of work
+    factory - a function factory(beg,end) that returns the
+              chunk for the work in [beg,end)
+    div     - the number of workers
+    sched   - 'guided', 'factoring', 'even' (splitnum) or a function
+              sched(num,div,minsize) that returns the sizes ['guided']
+    minsize - the minimum size of a chunk [1]
+
+  Returns the number of chunks and a generator of the chunks
+  (to be passed to dstr_collect, dstr_sum, ...)
+  """
+  if(sched == 'guided'):
+    sizes = guidedsplit(num,div,minsize)
+  elif(sched == 'factoring'):
+    sizes = factorsplit(num,div,minsize)
+  elif(sched == 'even'):
+    sizes = [size for size in splitnum(num,max(min(div,num//minsize),1)) if size > 0]
+  elif(callable(sched)):
+    sizes = sched(num,div,minsize)
+  else:
+    raise Exception("Scheduling must be 'guided', 'factoring', 'even' or a function")
+
+  def chunks():
+    beg = 0
+    for size in sizes:
+      yield factory(beg,beg+size)
+      beg += size
+
+  return len(sizes), chunks()
+
 def startserver(address="tcp://0.0.0.0:5555"):
   """
   Starts the server. A ZMQ REP socket
@@ -33,6 +118,41 @@ def startserver(address="tcp://0.0.0.0:5555"):
 
   return context, socket
 
+def release_results(socket,timeout=100):
+  """
+  Releases the results still sent to a server once it is done
+  (e.g., the duplicates in flight at the end of the last job with
+  speculate or lease). Results sent with codec 'shm' would otherwise
+  leave their shared memory segments in /dev/shm. Call it before
+  stopserver
+
+  Parameters:
+    socket  - a bound ZMQ socket (REP or ROUTER)
+    timeout - stop once no message arrives for timeout ms [100]
+
+  With a REP socket, each message is answered with an end-of-work
+  chunk and the function stops at the first message that is not a
+  result (an idle REQ worker asks again right away)
+
+  Returns the number of results released
+  """
+  nrel = 0
+  while(socket.poll(timeout)):
+    frames = socket.recv_multipart(copy=False)
+    if(socket.type == zmq.ROUTER):
+      frames = frames[1:]
+    else:
+      # A REQ worker waits for a reply (there is no more work)
+      socket.send_multipart(dumps_frames({}),copy=False)
+    ctl,whole = loads_ctl(frames)
+    if(ctl.get('msg') == "result"):
+      release_frames(frames)
+      nrel += 1
+    elif(socket.type != zmq.ROUTER):
+      break
+
+  return nrel
+
 def stopserver(context,socket,address="tcp://0.0.0.0:5555"):
   """
   Restarts the server. A ZMQ REP socket
@@ -44,3 +164,20 @@ def stopserver(context,socket,address="tcp://0.0.0.0:5555"):
   socket.close()
   context.destroy()
 
+def startrouter(address="tcp://0.0.0.0:5555"):
+  """
+  Starts a server with a ZMQ ROUTER socket. Allows
+  workers (DEALER sockets) to hold several chunks in flight
+
+  Parameters:
+   address - the address at which to bind the server
+             socket
+
+  Returns a ZMQ context and a ROUTER socket
+  """
+  context = zmq.Context()
+  socket = context.socket(zmq.ROUTER)
+  socket.bind(address)
+
+  return context, socket
+
@@ -0,0 +1,50 @@
+"""
+Fixtures of the tests that run a server with local workers
+
+@author: Joseph Jennings
+@version: 2020.10.20
+"""
+import itertools
+import numpy as np
+import pytest
+import zmq
+from client.localworkers import launch_localworkers
+
+# Addresses of the servers and contexts kept alive (the worker threads
+# cannot be stopped and keep their sockets open)
+_addrs = itertools.count()
+_contexts = []
+
+@pytest.fixture
+def server():
+  """
+  Returns a function start(kind,func,nworkers=2,**kwargs) that binds a
+  server socket of type kind (zmq.REP or zmq.ROUTER) and starts nworkers
+  inproc workers of func (REQ or DEALER) connected to it. The keyword
+  arguments are passed to launch_localworkers
+  """
+  sockets = []
+  def start(kind,func,nworkers=2,**kwargs):
+    context = zmq.Context()
+    socket = context.socket(kind)
+    address = "inproc://test-%d"%(next(_addrs))
+    socket.bind(address)
+    wkind = 'req' if(kind == zmq.REP) else 'dealer'
+    launch_localworkers(func,nworkers,address,wkind,context=context,**kwargs)
+    sockets.append(socket)
+    _contexts.append(context)
+    return socket
+  yield start
+  for socket in sockets:
+    socket.close(linger=0)
+
+def chunks(n,nx=10,fail=None):
+  """ A generator of n chunks (raises RuntimeError at chunk fail) """
+  for i in range(n):
+    if(i == fail):
+      raise RuntimeError("Interrupted")
+    yield {'i': i, 'dat': np.full(nx,i,dtype='float32')}
+
+def double(chunk):
+  """ A worker function that doubles the data of a chunk """
+  return {'i': chunk['i'], 'result': 2*chunk['dat']}
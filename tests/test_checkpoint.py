@@ -0,0 +1,64 @@
+"""
+Tests of the checkpoint journal (server.checkpoint)
+
+@author: Joseph Jennings
+@version: 2020.10.19
+"""
+import os
+import numpy as np
+from server.checkpoint import checkpoint
+
+def test_resume_lists(tmp_path):
+  ck = checkpoint(str(tmp_path))
+  ck.save([0,1],{'result': [10,11]})
+  ck.save([2],{'result': [10,11,12]})
+  rk = checkpoint(str(tmp_path),resume=True)
+  assert rk.cids == {0,1,2}
+  assert rk.restore('result') == [10,11,12]
+
+def test_truncated_journal(tmp_path):
+  ck = checkpoint(str(tmp_path))
+  ck.save([0,1],{'result': [10,11]})
+  good = os.path.getsize(ck.fname)
+  ck.save([2,3],{'result': [10,11,12,13]})
+  # The last save was interrupted while being written
+  with open(ck.fname,'r+b') as f:
+    f.truncate(os.path.getsize(ck.fname) - 5)
+  rk = checkpoint(str(tmp_path),resume=True)
+  assert rk.cids == {0,1}
+  assert rk.restore('result') == [10,11]
+  # The incomplete record is dropped so that new saves can be read back
+  assert os.path.getsize(rk.fname) == good
+  rk.save([2],{'result': [10,11,12]})
+  assert checkpoint(str(tmp_path),resume=True).restore('result') == [10,11,12]
+
+def test_resume_rows(tmp_path):
+  out = np.zeros((4,3),dtype='float32')
+  ck = checkpoint(str(tmp_path))
+  out[1] = 1; out[3] = 3
+  ck.save([1,3],{'result': out})
+  out[0] = 5
+  ck.save([0],{'result': out})
+  res = checkpoint(str(tmp_path),resume=True).restore('result')
+  assert np.array_equal(res,out)
+
+def test_resume_snapshot(tmp_path):
+  out = np.ones((2,3),dtype='float32')
+  ck = checkpoint(str(tmp_path))
+  ck.save([0],{'result': out},accumulated=True)
+  out += 1
+  ck.save([1],{'result': out},accumulated=True)
+  # Only the latest snapshot is kept
+  assert len([f for f in os.listdir(str(tmp_path)) if f.startswith('snap-')]) == 1
+  # Results added after the last save are not restored
+  out += 1
+  rk = checkpoint(str(tmp_path),resume=True)
+  assert rk.cids == {0,1}
+  assert np.array_equal(rk.restore('result'),np.full((2,3),2,dtype='float32'))
+
+def test_due_scales_with_save_time(tmp_path):
+  ck = checkpoint(str(tmp_path),freq=0.0)
+  assert ck.due()
+  # A slow save spaces the next checkpoints
+  ck.tsave = 100.0
+  assert not ck.due()
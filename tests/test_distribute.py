@@ -0,0 +1,205 @@
+"""
+End-to-end tests of the distribution engines (server.distribute)
+with inproc workers (client.localworkers)
+
+@author: Joseph Jennings
+@version: 2020.10.20
+"""
+import os, time
+import threading
+import numpy as np
+import pytest
+import zmq
+from server.distribute import dstr_collect, dstr_sum, dstr_imap, dstr_imap_unordered
+from server.broadcast import broadcaster
+from server.pool import workpool
+from server.checkpoint import checkpoint
+from server.utils import release_results
+import client.worker as worker
+from client.worker import partialsum, shipped
+from client.cache import sharedcache, defaultcache
+from client.aggregator import aggregator
+from client.localworkers import launch_localworkers
+from comm.relay import relay
+from conftest import chunks, double
+
+kinds = pytest.mark.parametrize('kind',[zmq.REP,zmq.ROUTER],ids=['rep','router'])
+
+def expected(n,nx=10):
+  return np.array([2*np.full(nx,i,dtype='float32') for i in range(n)])
+
+@kinds
+@pytest.mark.parametrize('args',[{},{'batch': 3},{'nthreads': 2},{'codec': 'auto'},
+                                 {'prefetch': 2},{'batch': 'auto','codec': 'adapt'}],
+                         ids=['plain','batch','nthreads','auto','prefetch','adapt'])
+def test_collect(server,kind,args):
+  socket = server(kind,double)
+  n = 20
+  odict = dstr_collect(['i','result'],n,chunks(n),socket,**args)
+  order = np.argsort(odict['i'])
+  assert sorted(odict['i']) == list(range(n))
+  assert np.array_equal(np.array(odict['result'])[order],expected(n))
+
+@kinds
+def test_collect_outputs(server,kind):
+  socket = server(kind,double)
+  n = 15
+  odict = dstr_collect(['result'],n,chunks(n),socket,batch=2,nthreads=2,
+                       outputs={'result': ((n,10),'float32')})
+  assert np.array_equal(odict['result'],expected(n))
+
+@kinds
+def test_collect_lazy(server,kind):
+  socket = server(kind,double)
+  n = 12
+  odict = dstr_collect(['i','result'],n,chunks(n),socket,lazy=True,codec='auto')
+  assert len(odict['result']) == n
+  for i,res in zip(odict['i'],odict['result']):
+    assert np.array_equal(res,2*np.full(10,i,dtype='float32'))
+
+@kinds
+@pytest.mark.parametrize('args',[{},{'batch': 4},{'nthreads': 3}],ids=['plain','batch','nthreads'])
+def test_sum(server,kind,args):
+  socket = server(kind,double)
+  n = 20
+  out = dstr_sum('i','result',n,chunks(n),socket,(10,),**args)
+  assert np.allclose(out,expected(n).sum(axis=0))
+
+@pytest.mark.parametrize('args',[{},{'batch': 4}],ids=['plain','batch'])
+def test_sum_partial(server,args):
+  socket = server(zmq.ROUTER,double,reducer=lambda: partialsum('result',nflush=3))
+  n = 20
+  out = dstr_sum('i','result',n,chunks(n),socket,(10,),**args)
+  assert np.allclose(out,expected(n).sum(axis=0))
+
+def test_sum_outfile(server,tmp_path):
+  socket = server(zmq.ROUTER,double)
+  n = 10
+  fname = str(tmp_path/'sum.dat')
+  out = dstr_sum('i','result',n,chunks(n),socket,(10,),outfile=fname)
+  assert isinstance(out,np.memmap)
+  assert np.allclose(np.fromfile(fname,dtype='float32'),expected(n).sum(axis=0))
+
+@kinds
+def test_imap(server,kind):
+  socket = server(kind,double)
+  n = 15
+  res = list(dstr_imap(n,chunks(n),socket,maxbuf=4))
+  assert [i for i,rdict in res] == list(range(n))
+  assert np.array_equal(np.array([rdict['result'] for i,rdict in res]),expected(n))
+  res = list(dstr_imap_unordered(n,chunks(n),socket))
+  assert sorted([i for i,rdict in res]) == list(range(n))
+
+def scaled(chunk):
+  return {'i': chunk['i'], 'result': chunk['scale']*chunk['dat']}
+
+@kinds
+def test_broadcast(server,kind):
+  socket = server(kind,scaled)
+  shared = broadcaster(codec='auto')
+  shared.register('scale',np.float32(2.0))
+  n = 10
+  odict = dstr_collect(['i','result'],n,chunks(n),socket,shared=shared)
+  order = np.argsort(odict['i'])
+  assert np.array_equal(np.array(odict['result'])[order],expected(n))
+  # A new object for the next job
+  shared.register('scale',np.float32(1.0))
+  out = dstr_sum('i','result',n,chunks(n),socket,(10,),shared=shared)
+  assert np.allclose(out,expected(n).sum(axis=0)/2)
+
+@kinds
+def test_workpool(server,kind):
+  socket = server(kind,shipped)
+  pool = workpool(socket,batch=2)
+  n = 10
+  # A job started later keeps its own function
+  it = pool.imap(lambda chunk: {'result': 3*chunk['dat']},n,chunks(n))
+  odict = pool.collect(double,['i','result'],n,chunks(n))
+  assert sorted(odict['i']) == list(range(n))
+  res = np.array([rdict['result'] for i,rdict in it])
+  assert np.array_equal(res,1.5*expected(n))
+
+def test_workpool_shipped(server):
+  # A long-lived worker keeps only the most recent functions (by hash)
+  socket = server(zmq.ROUTER,shipped,nworkers=1)
+  pool = workpool(socket)
+  n = 4
+  for k in range(worker._NSHIPPED + 3):
+    odict = pool.collect(lambda chunk,k=k: {'i': chunk['i'], 'result': k*chunk['dat']},
+                         ['i','result'],n,chunks(n))
+    assert np.array_equal(np.array(odict['result'])[np.argsort(odict['i'])],k*expected(n)/2)
+  assert len(worker._shipped) <= worker._NSHIPPED
+  assert all([isinstance(hsh,str) for hsh in worker._shipped])
+
+def test_defaultcache():
+  cache = defaultcache()
+  assert cache.maxbytes is not None and cache.maxbytes > 0
+
+def test_broadcast_tree(server):
+  socket = server(zmq.ROUTER,scaled,nworkers=3,
+                  cache=lambda: sharedcache(relay=relay(host='127.0.0.1')))
+  shared = broadcaster(fanout=1,host='127.0.0.1',blocksize=64)
+  shared.register('scale',np.full(10,2,dtype='float32'))
+  n = 12
+  out = dstr_sum('i','result',n,chunks(n),socket,(10,),shared=shared)
+  assert np.allclose(out,expected(n).sum(axis=0))
+
+@pytest.mark.parametrize('rkey',[None,'result'],ids=['forward','sum'])
+def test_aggregator(server,rkey):
+  socket = server(zmq.ROUTER,double,nworkers=0)
+  context = socket.context
+  address = socket.getsockopt(zmq.LAST_ENDPOINT).decode()
+  backend = context.socket(zmq.DEALER)
+  backend.connect(address)
+  frontend = context.socket(zmq.ROUTER)
+  frontend.bind(address + "-agg")
+  threading.Thread(target=aggregator,args=(frontend,backend,rkey),daemon=True).start()
+  launch_localworkers(double,3,address + "-agg",context=context)
+  n = 20
+  for ijob in range(2):
+    out = dstr_sum('i','result',n,chunks(n),socket,(10,),batch=3)
+    assert np.allclose(out,expected(n).sum(axis=0))
+
+@kinds
+@pytest.mark.parametrize('args',[{},{'nthreads': 3},{'outfile': True}],
+                         ids=['plain','nthreads','outfile'])
+def test_sum_resume(server,tmp_path,kind,args):
+  n = 30
+  ckpt = str(tmp_path/'ckpt')
+  if(args.get('outfile',False)):
+    args = {'outfile': str(tmp_path/'sum.dat')}
+  # The generator fails part way through the job
+  socket = server(kind,double)
+  with pytest.raises(RuntimeError):
+    dstr_sum('i','result',n,chunks(n,fail=17),socket,(10,),ckpt=ckpt,ckptfreq=0.0,**args)
+  ck = checkpoint(ckpt,resume=True)
+  assert 0 < len(ck.cids) <= 17
+  # Resumed on a new server, the chunks already summed are skipped
+  socket = server(kind,double)
+  out = dstr_sum('i','result',n,chunks(n),socket,(10,),ckpt=ckpt,resume=True,**args)
+  assert np.allclose(out,expected(n).sum(axis=0))
+
+@kinds
+def test_collect_resume(server,tmp_path,kind):
+  n = 20
+  ckpt = str(tmp_path/'ckpt')
+  outputs = {'result': ((n,10),'float32')}
+  socket = server(kind,double)
+  with pytest.raises(RuntimeError):
+    dstr_collect(['result'],n,chunks(n,fail=11),socket,outputs=outputs,ckpt=ckpt,ckptfreq=0.0)
+  socket = server(kind,double)
+  odict = dstr_collect(['result'],n,chunks(n),socket,outputs=outputs,ckpt=ckpt,resume=True)
+  assert np.array_equal(odict['result'],expected(n))
+
+@kinds
+def test_release_results(server,kind):
+  socket = server(kind,double,codec='shm')
+  before = set(os.listdir('/dev/shm'))
+  # More chunks than results: the workers are still sending results at the end
+  n = 6
+  res = list(dstr_imap_unordered(n,chunks(3*n,nx=40000),socket))
+  assert len(res) == n
+  del res
+  time.sleep(0.2)
+  assert release_results(socket) > 0
+  assert set(os.listdir('/dev/shm')) <= before
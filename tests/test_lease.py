@@ -0,0 +1,105 @@
+"""
+Tests of the leases, the re-dispatch of chunks and the speculative
+copies (server.dispatch) with inproc workers (client.localworkers)
+
+@author: Joseph Jennings
+@version: 2020.10.20
+"""
+import time
+import threading
+import numpy as np
+import pytest
+import zmq
+from server.distribute import dstr_collect, dstr_sum
+from client.worker import partialsum
+from conftest import chunks, double
+
+kinds = pytest.mark.parametrize('kind',[zmq.REP,zmq.ROUTER],ids=['rep','router'])
+
+def expected(n,nx=10):
+  return np.array([2*np.full(nx,i,dtype='float32') for i in range(n)])
+
+class stall:
+  """
+  A worker function that stalls the first worker to get chunk icid
+  (for wait seconds or until released, e.g., a lost worker)
+  """
+
+  def __init__(self,icid,wait=None,delay=0.0):
+    self.icid  = icid
+    self.wait  = wait
+    self.delay = delay
+    self.lock  = threading.Lock()
+    self.done  = threading.Event()
+    self.hit   = False
+
+  def __call__(self,chunk):
+    with self.lock:
+      hit = chunk['i'] == self.icid and not self.hit
+      if(hit): self.hit = True
+    if(hit):
+      self.done.wait(self.wait)
+    time.sleep(self.delay)
+    return double(chunk)
+
+@pytest.fixture
+def stalls():
+  """ Releases the stalled workers at the end of a test """
+  funcs = []
+  yield funcs.append
+  for func in funcs:
+    func.done.set()
+
+def check_collect(odict,n):
+  order = np.argsort(odict['i'])
+  assert sorted(odict['i']) == list(range(n))
+  assert np.array_equal(np.array(odict['result'])[order],expected(n))
+
+@kinds
+def test_lost_worker(server,stalls,kind):
+  func = stall(3); stalls(func)
+  socket = server(kind,func,nworkers=3)
+  n,stats = 20,{}
+  odict = dstr_collect(['i','result'],n,chunks(n),socket,lease=0.2,stats=stats)
+  check_collect(odict,n)
+  assert stats['nexpired'] >= 1
+
+@kinds
+def test_late_duplicate(server,kind):
+  # The first copy of chunk 0 arrives after the copy handed out again
+  socket = server(kind,stall(0,wait=0.5,delay=0.02),nworkers=2)
+  n,stats = 60,{}
+  odict = dstr_collect(['i','result'],n,chunks(n),socket,lease=0.1,stats=stats)
+  check_collect(odict,n)
+  assert stats['nexpired'] >= 1
+  assert stats['ndup'] >= 1
+
+@kinds
+def test_speculate_stale(server,stalls,kind):
+  func = stall(9,wait=0.5); stalls(func)
+  socket = server(kind,func,nworkers=2)
+  n,stats = 10,{}
+  odict = dstr_collect(['i','result'],n,chunks(n),socket,speculate=1,stats=stats)
+  check_collect(odict,n)
+  assert stats['nspec'] >= 1
+  # The late copy of the previous job is discarded by the next one
+  time.sleep(0.5)
+  odict = dstr_collect(['i','result'],n,chunks(n),socket)
+  check_collect(odict,n)
+
+def test_lost_partialsum(server,stalls):
+  # A worker is lost while holding chunks in its partial sum
+  func = stall(8); stalls(func)
+  socket = server(zmq.ROUTER,func,nworkers=3,reducer=lambda: partialsum('result'))
+  n,stats = 20,{}
+  out = dstr_sum('i','result',n,chunks(n),socket,(10,),lease=0.2,stats=stats)
+  assert np.allclose(out,expected(n).sum(axis=0))
+  assert stats['nexpired'] >= 1
+
+def test_partialsum_rep(server):
+  # The chunks in the partial sums of REQ workers are not leased
+  socket = server(zmq.REP,double,nworkers=2,reducer=lambda: partialsum('result'))
+  n = 20
+  with pytest.warns(UserWarning):
+    out = dstr_sum('i','result',n,chunks(n),socket,(10,),lease=0.2)
+  assert np.allclose(out,expected(n).sum(axis=0))
@@ -0,0 +1,96 @@
+"""
+Tests of the message encoding (comm.sendrecv)
+
+@author: Joseph Jennings
+@version: 2020.10.19
+"""
+import os, pickle
+import numpy as np
+import pytest
+import comm.sendrecv as sendrecv
+from comm.sendrecv import dumps_frames, loads_frames, loads_ctl, get_codecs, select_codec, \
+                          shuffle, unshuffle, needs_decode, release_frames, _ENVTAG, _CTLKEYS
+
+def chunk():
+  return {'dat': np.random.rand(64,50).astype('float32'), 'idx': np.arange(2000),
+          'small': np.ones(3,dtype='float64'), 'name': "shot"}
+
+def check(res,ref):
+  assert res.keys() == ref.keys()
+  for key,val in ref.items():
+    if(isinstance(val,np.ndarray)):
+      assert res[key].dtype == val.dtype
+      assert np.array_equal(res[key],val)
+      # Decoded arrays can be written to
+      res[key][...] = 0
+    else:
+      assert res[key] == val
+
+@pytest.mark.parametrize('codec',[name for name in get_codecs() if(name != 'shm')] + ['auto'])
+def test_codec_roundtrip(codec):
+  ref = chunk()
+  check(loads_frames(dumps_frames(ref,codec=codec)),ref)
+
+@pytest.mark.parametrize('oob',[False,True])
+def test_roundtrip(oob):
+  ref = chunk()
+  check(loads_frames(dumps_frames(ref,oob=oob)),ref)
+
+def test_roundtrip_bytes():
+  # Frames received as (read-only) bytes
+  ref = chunk()
+  frames = [bytes(frame) for frame in dumps_frames(ref,codec='auto')]
+  check(loads_frames(frames),ref)
+
+def test_info():
+  info = {}
+  frames = dumps_frames(chunk(),codec='auto',info=info)
+  assert info['nbytes'] < info['raw']
+
+def test_envelope():
+  ref = chunk()
+  ctl = {'msg': "result", '_cid': 3}
+  assert set(ctl.keys()) <= set(_CTLKEYS)
+  frames = [_ENVTAG, pickle.dumps(ctl)] + dumps_frames(ref,codec='auto')
+  rctl,whole = loads_ctl(frames)
+  assert rctl == ctl and not whole
+  res = loads_frames(frames)
+  assert res['_cid'] == 3
+  check({key: res[key] for key in ref},ref)
+
+def test_select_codec():
+  assert select_codec(memoryview(np.ones(10,dtype='float32'))) == 'none'
+  # Only codecs that every host can decode
+  assert select_codec(memoryview(np.ones(1000,dtype='float32'))) == 'shuffle-lz4'
+  assert select_codec(memoryview(np.ones(1000,dtype='int64'))) == 'lz4'
+
+def test_missing_codec(monkeypatch):
+  # A message encoded with zstd received by a host without zstandard
+  frames = dumps_frames(chunk(),codec='none')
+  frames[1] = frames[1].replace(b"none",b"shuffle-zstd")
+  monkeypatch.delitem(sendrecv._codecs,'shuffle-zstd',raising=False)
+  with pytest.raises(Exception,match="zstandard"):
+    loads_frames(frames)
+  with pytest.raises(Exception,match="Unknown codec"):
+    dumps_frames(chunk(),codec='nope')
+
+def test_shuffle():
+  buf = np.random.rand(100).astype('float32').tobytes()
+  assert bytes(unshuffle(shuffle(buf,4),4)) == buf
+
+@pytest.mark.skipif('shm' not in get_codecs(),reason="no shared memory")
+def test_shm_release():
+  ref = {'dat': np.random.rand(100000)}
+  frames = dumps_frames(ref,codec='shm')
+  assert needs_decode(frames)
+  before = set(os.listdir('/dev/shm'))
+  res = loads_frames(frames)
+  check(res,ref)
+  # The segment is removed once the decoded arrays are released
+  del res
+  assert len(before - set(os.listdir('/dev/shm'))) == 1
+  # A message that is never decoded is released
+  frames = dumps_frames(ref,codec='shm')
+  before = set(os.listdir('/dev/shm'))
+  release_frames(frames)
+  assert len(before - set(os.listdir('/dev/shm'))) == 1
@@ -0,0 +1,39 @@
+"""
+Tests of the splitting of the work into chunks (server.utils)
+
+@author: Joseph Jennings
+@version: 2020.10.19
+"""
+import pytest
+from server.utils import splitnum, guidedsplit, factorsplit, schedchunks
+
+def test_splitnum():
+  assert splitnum(10,3) == [4,3,3]
+  assert splitnum(2,4) == [1,1,0,0]
+
+def test_guidedsplit():
+  assert guidedsplit(100,4) == [25,19,14,11,8,6,5,3,3,2,1,1,1,1]
+  sizes = guidedsplit(1000,8,minsize=10)
+  assert sum(sizes) == 1000
+  assert all([size >= 10 for size in sizes[:-1]])
+  assert sizes == sorted(sizes,reverse=True)
+
+def test_factorsplit():
+  assert factorsplit(100,4) == [13,13,13,13,6,6,6,6,3,3,3,3,2,2,2,2,1,1,1,1]
+  sizes = factorsplit(1000,8,minsize=10)
+  assert sum(sizes) == 1000
+  assert all([size >= 10 for size in sizes[:-1]])
+  assert sizes == sorted(sizes,reverse=True)
+
+@pytest.mark.parametrize('sched',['guided','factoring','even'])
+def test_schedchunks(sched):
+  nchunks,chunks = schedchunks(103,lambda beg,end: (beg,end),4,sched,minsize=2)
+  ranges = list(chunks)
+  assert len(ranges) == nchunks
+  # The chunks cover the range in order
+  assert ranges[0][0] == 0 and ranges[-1][1] == 103
+  assert all([ranges[i][1] == ranges[i+1][0] for i in range(nchunks-1)])
+
+def test_schedchunks_unknown():
+  with pytest.raises(Exception):
+    schedchunks(10,lambda beg,end: (beg,end),2,'static')